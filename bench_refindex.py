@@ -0,0 +1,56 @@
+#rows/second of the reference lookup on a synthetic 96-sample plate: refsequence.find() per row
+#against one RefIndex shared by the whole plate.  python bench_refindex.py [rows per sample]
+import os
+import sys
+import time
+import random
+import importlib.util
+
+spec = importlib.util.spec_from_file_location('findfreq', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'findfreq2026-A4.py'))
+findfreq = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(findfreq)
+
+
+def syntheticplate(refsequence, samples=96, rows=1700, seed=1):
+    #Reference_Sequence chunks as CRISPResso writes them: ~110 bp windows around the cut site, a few with an
+    #insertion that is not in the amplicon. alleles recur across samples like WT/CS/CR do on a real plate
+    rnd = random.Random(seed)
+    cutsite = refsequence.find(findfreq.RULESETS['a4']['marker'])
+    common = []
+    for i in range(400):
+        start = max(0, cutsite - 60 + rnd.randint(-25, 25))
+        chunk = refsequence[start:start + rnd.randint(100, 120)]
+        if rnd.random() < 0.05:
+            q = rnd.randint(1, len(chunk) - 1)
+            chunk = chunk[:q] + ''.join(rnd.choice('ACGT') for _ in range(rnd.randint(1, 6))) + chunk[q:]
+        common.append(chunk)
+    return [[rnd.choice(common) for _ in range(rows)] for _ in range(samples)]
+
+
+def rowspersecond(plate, find):
+    nrows = sum(len(sample) for sample in plate)
+    start = time.perf_counter()
+    offsets = [[find(chunk) for chunk in sample] for sample in plate]
+    return nrows / (time.perf_counter() - start), offsets
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    rows = int(argv[0]) if argv else 1700
+    refsequence = findfreq.REFSEQUENCE
+    plate = syntheticplate(refsequence, rows=rows)
+    print(f"{len(plate)} samples, {sum(len(sample) for sample in plate)} rows, {len(refsequence)} bp reference")
+
+    before, expected = rowspersecond(plate, refsequence.find)
+    refindex = findfreq.RefIndex(refsequence)
+    after, offsets = rowspersecond(plate, refindex.find)
+    if offsets != expected:
+        print("RefIndex offsets differ from str.find")
+        return 1
+    print(f"str.find:       {before:12,.0f} rows/s")
+    print(f"RefIndex.find:  {after:12,.0f} rows/s  ({after / before:.1f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,152 +1,1016 @@
-import tkinter as tk
-from tkinter import filedialog, simpledialog
 import os
+import sys
+import csv
 import json
-import webbrowser
+import argparse
+import re
+import io
+import gzip
+import zipfile
+import heapq
+import hashlib
+import pickle
+import zlib
+import mmap
 import random
 import statistics
-import matplotlib.pyplot as plt
+import time
+import sqlite3
 import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
+from collections import OrderedDict
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 
+GAPRUN = re.compile(r'-+')
+
+
 def getLD(seq):
+    return getLDrun(seq)[0]
+
+
+def gapsignature(seq, offset=0):
+    #[(start, length), ...] of the gap runs in seq[offset:], left to right, in one regex pass.
+    #start is a position in seq; a run crossing offset only counts from offset on
+    return [(match.start(), match.end() - match.start()) for match in GAPRUN.finditer(seq, offset)]
+
+
+def getLDrun(seq, offset=36):
+    #(longest gap run, its start, its end, number of gap runs) in seq[offset:], from gapsignature().
+    #start/end are positions in seq, end exclusive; the first run wins a tie; -1/-1 when there is no gap
+    signature = gapsignature(seq, offset)
     maxdel = 0
-    currdel = 0
-    
-    for char in seq[36:]:
-        if char == '-':
-            currdel += 1
-            maxdel = max(maxdel, currdel)
+    maxstart = -1
+    for start, length in signature:
+        if length > maxdel:
+            maxdel = length
+            maxstart = start
+    return (maxdel, maxstart, maxstart + maxdel if maxdel else -1, len(signature))
+
+
+def gaprunsbatch(gaps, offset=0):
+    #getLDrun for every row of a boolean gap matrix at once: arrays of (longest, start, end, runs).
+    #run edges come from np.diff of the zero-padded mask, offset is added to the positions
+    nrows = gaps.shape[0]
+    longest = np.zeros(nrows, dtype=np.int64)
+    start = np.full(nrows, -1, dtype=np.int64)
+    end = np.full(nrows, -1, dtype=np.int64)
+    if nrows == 0 or gaps.shape[1] == 0:
+        return longest, start, end, np.zeros(nrows, dtype=np.int64)
+
+    padded = np.zeros((nrows, gaps.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = gaps
+    edges = np.diff(padded, axis=1)
+    #row-major order pairs every run start with its own end
+    runrows, runstarts = np.nonzero(edges == 1)
+    runends = np.nonzero(edges == -1)[1]
+    runlengths = runends - runstarts
+    runs = np.bincount(runrows, minlength=nrows)
+
+    if len(runrows):
+        #longest run per row, leftmost first on ties
+        order = np.lexsort((runstarts, -runlengths, runrows))
+        first = order[np.r_[True, runrows[order][1:] != runrows[order][:-1]]]
+        longest[runrows[first]] = runlengths[first]
+        start[runrows[first]] = runstarts[first] + offset
+        end[runrows[first]] = runends[first] + offset
+    return longest, start, end, runs
+
+
+def seqmatrix(seqs, minwidth=0):
+    #NUL-padded uint8 matrix (one row per sequence) and the sequence lengths; str or bytes rows
+    nrows = len(seqs)
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=nrows)
+    width = max(int(lengths.max()) if nrows else 0, minwidth)
+    #pad with NUL so padding never reads as a gap; bytes rows from the mmap reader go in as they are
+    if nrows and isinstance(seqs[0], bytes):
+        packed = b''.join([seq.ljust(width, b'\0') for seq in seqs])
+    else:
+        packed = ''.join([seq.ljust(width, '\0') for seq in seqs]).encode('ascii')
+    return np.frombuffer(packed, dtype=np.uint8).reshape(nrows, width), lengths
+
+
+def getLDbatch(seqs, offset=36):
+    #getLDrun over many aligned sequences: arrays of (longest, start, end, runs)
+    matrix, lengths = seqmatrix(seqs, offset)
+    return gaprunsbatch(matrix[:, offset:] == ord('-'), offset)
+
+
+ALLELETYPES = ['cs', 'cr', 'nhej', 'other', 'insertion', 'recomb', 'artifwt', 'unknown']
+ALLELECODES = {alleletype: code for code, alleletype in enumerate(ALLELETYPES)}
+
+
+class Allele:
+    #one row of a result (top sequences and NHEJ alleles). slots instead of a dict per row, the type
+    #as its index into ALLELETYPES, and the sequence interned so an allele seen in many samples is stored once
+    #LDel/LDelstart/LDelend/ngapruns describe the gaps after position 36 (see getLDrun) for nhej rows
+    __slots__ = ('alignedseq', 'reads', 'percentage', 'typecode', 'LDel', 'LDelstart', 'LDelend', 'ngapruns')
+
+    def __init__(self, alignedseq, reads, percentage, alleletype, LDel=0, LDelstart=-1, LDelend=-1, ngapruns=0):
+        #alleletype is a name from ALLELETYPES or its code
+        self.alignedseq = sys.intern(alignedseq)
+        self.reads = reads
+        self.percentage = percentage
+        self.typecode = ALLELECODES[alleletype] if isinstance(alleletype, str) else int(alleletype)
+        self.LDel = LDel
+        self.LDelstart = LDelstart
+        self.LDelend = LDelend
+        self.ngapruns = ngapruns
+
+    @property
+    def type(self):
+        return ALLELETYPES[self.typecode]
+
+    def __reduce__(self):
+        #unpickled results (pool workers, result cache) go back through the interning
+        return (Allele, (self.alignedseq, self.reads, self.percentage, self.typecode,
+                         self.LDel, self.LDelstart, self.LDelend, self.ngapruns))
+
+    def __eq__(self, other):
+        return isinstance(other, Allele) and self.__reduce__() == other.__reduce__()
+
+    def __hash__(self):
+        return hash(self.__reduce__()[1])
+
+    def __repr__(self):
+        return "Allele(" + ", ".join(repr(value) for value in (self.alignedseq, self.reads, self.percentage, self.type,
+                                                                self.LDel, self.LDelstart, self.LDelend, self.ngapruns)) + ")"
+
+
+def deletionhistogram(NHEJList):
+    #size -> allele count/read count, one pass over the distinct alleles
+    size_dict = {}
+    for allele in NHEJList:
+        if allele.LDel not in size_dict:
+            size_dict[allele.LDel] = {'count': 0, 'reads': 0}
+        size_dict[allele.LDel]['count'] += 1
+        size_dict[allele.LDel]['reads'] += allele.reads
+    return size_dict
+
+
+def weightedpercentile(sizes, cumreads, q):
+    #same interpolation as statistics.median on the per-read list, but walks the cumulative reads instead
+    n = cumreads[-1]
+    pos = q * (n - 1)
+    lowrank = int(pos)
+    highrank = min(lowrank + 1, n - 1)
+    frac = pos - lowrank
+
+    def valueatrank(rank):
+        lo, hi = 0, len(cumreads) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumreads[mid] > rank:
+                hi = mid
+            else:
+                lo = mid + 1
+        return sizes[lo]
+
+    low = valueatrank(lowrank)
+    if frac == 0:
+        return low
+    return low + frac * (valueatrank(highrank) - low)
+
+
+def deletionstats(NHEJList):
+    #weighted by reads without expanding every read into a list
+    return histogramstats(deletionhistogram(NHEJList))
+
+
+def histogramstats(size_dict):
+    #mean/median/stdev/max/percentiles of deletion length from a deletionhistogram() dict
+    sizes = sorted(size_dict.keys())
+    read_counts = [size_dict[s]['reads'] for s in sizes]
+
+    cumreads = []
+    running = 0
+    for r in read_counts:
+        running += r
+        cumreads.append(running)
+
+    totalreads = running
+    if totalreads == 0:
+        return {'size_dict': size_dict, 'sizes': sizes, 'read_counts': read_counts, 'reads': 0,
+                'mean': 0, 'median': 0, 'stdev': 0, 'max': 0, 'p10': 0, 'p25': 0, 'p75': 0, 'p90': 0}
+
+    sumlen = sum(s * r for s, r in zip(sizes, read_counts))
+    sumsq = sum(s * s * r for s, r in zip(sizes, read_counts))
+    #integer numerator so the variance matches statistics.stdev
+    stdev = ((totalreads * sumsq - sumlen * sumlen) / (totalreads * (totalreads - 1))) ** 0.5 if totalreads > 1 else 0
+
+    return {
+        'size_dict': size_dict,
+        'sizes': sizes,
+        'read_counts': read_counts,
+        'reads': totalreads,
+        'mean': sumlen / totalreads,
+        'median': weightedpercentile(sizes, cumreads, 0.5),
+        'stdev': stdev,
+        'max': max(s for s in sizes if size_dict[s]['reads'] > 0),
+        'p10': weightedpercentile(sizes, cumreads, 0.10),
+        'p25': weightedpercentile(sizes, cumreads, 0.25),
+        'p75': weightedpercentile(sizes, cumreads, 0.75),
+        'p90': weightedpercentile(sizes, cumreads, 0.90),
+    }
+
+
+class RefIndex:
+    #fixed-length prefixes of the amplicon -> offsets, checked with one compare.
+    #build once per reference and share it across every file in a run
+    def __init__(self, refsequence, k=12, maxcached=200000):
+        self.refsequence = refsequence
+        self.k = k
+        self.maxcached = maxcached
+        self.prefixes = {}
+        for i in range(len(refsequence) - k + 1):
+            self.prefixes.setdefault(refsequence[i:i + k], []).append(i)
+        self.found = {}
+
+    def lookup(self, refseqinfile):
+        if len(refseqinfile) < self.k:
+            return self.refsequence.find(refseqinfile)
+        for i in self.prefixes.get(refseqinfile[:self.k], ()):
+            if self.refsequence.startswith(refseqinfile, i):
+                return i
+        return -1
+
+    def find(self, refseqinfile):
+        #same result as refsequence.find(refseqinfile)
+        start = self.found.get(refseqinfile)
+        if start is None:
+            start = self.lookup(refseqinfile.decode('ascii') if isinstance(refseqinfile, bytes) else refseqinfile)
+            if len(self.found) < self.maxcached:
+                self.found[refseqinfile] = start
+        return start
+
+
+#bump when the classification rules or the result layout change so cached results are not reused
+CLASSIFIERVARIANT = "A4-recomb-insertion-4"
+
+RECOMBSEQ1 = "TTCCGGTGCCGGAAAGACGACCCT------------TGCCTTTCGATCGCCGCAG---ATCCAAGTATCGCCATCCGGGATGCGACTGCTCAATGGCCAACCTGTGGACG"
+RECOMBSEQ2 = "TTCCGGTGCCGGAAAGACGACCCTGCTGAATGCCCTTGCCTTTCGATCGCCGCAGGGCATCCAAGTATCGCCATCCGGGATGCGACTGCTCAATGGCCAACCTGTGGACG"
+
+
+def sniffdialect(text):
+    #csv dialect of a CSV/TSV sheet from its header line; ValueError for an empty file
+    lines = text.splitlines()
+    if not lines or not lines[0].strip():
+        raise ValueError("empty file")
+    return csv.Sniffer().sniff(lines[0], delimiters=',\t')
+
+
+class AlleleCatalog:
+    #known alleles (recombinants, donor templates, PCR artifacts) -> label, as two dicts so a row costs one
+    #hash lookup however big the catalog gets: aligned sequences matched exactly, and sequences with their
+    #gaps stripped. keys are stored as str and bytes so raw rows from readalleletable match too
+    MATCHES = ('exact', 'stripped')
+
+    def __init__(self, entries=()):
+        self.exact = {}
+        self.stripped = {}
+        self.entries = []
+        self.fingerprintcache = None
+        for entry in entries:
+            self.add(*entry)
+
+    def add(self, sequence, label, match='exact'):
+        if match not in self.MATCHES:
+            raise ValueError(f"unknown match {match!r} for known allele {label!r} (expected one of {', '.join(self.MATCHES)})")
+        key = sequence.replace('-', '') if match == 'stripped' else sequence
+        index = self.stripped if match == 'stripped' else self.exact
+        index[key] = label
+        index[key.encode('ascii')] = label
+        self.entries.append((sequence, label, match))
+        self.fingerprintcache = None
+
+    def load(self, path):
+        #CSV or TSV with sequence and label columns, optionally match (exact or stripped, default exact)
+        with open(path, 'r', newline='') as f:
+            text = f.read()
+        dialect = sniffdialect(text)
+        for row in csv.DictReader(text.splitlines(), dialect=dialect):
+            row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+            if row.get('sequence'):
+                self.add(row['sequence'], row.get('label') or row['sequence'], row.get('match') or 'exact')
+        return self
+
+    def lookup(self, alignedseq):
+        #label of a known allele, or None
+        label = self.exact.get(alignedseq)
+        if label is None and self.stripped:
+            if isinstance(alignedseq, bytes):
+                label = self.stripped.get(alignedseq.replace(b'-', b''))
+            else:
+                label = self.stripped.get(alignedseq.replace('-', ''))
+        return label
+
+    def fingerprint(self):
+        #changes whenever an entry does, for cache keys
+        if self.fingerprintcache is None:
+            self.fingerprintcache = hashlib.sha1(repr(sorted(self.entries)).encode()).hexdigest()
+        return self.fingerprintcache
+
+    def __len__(self):
+        return len(self.entries)
+
+
+#the built-in known alleles; --catalog adds to these
+KNOWNALLELES = AlleleCatalog([(RECOMBSEQ1, 'recomb1'), (RECOMBSEQ2, 'recomb2')])
+
+#the classification schemes of the findfreq scripts, as data.
+#marker/markeroffset: the CR window starts this far past the cut-site marker.
+#csfrom/csmin: a CS allele has a gap run covering csfrom that reaches at least csmin past it.
+#gapsfrom: CS alleles with any gap ending past this are NHEJ candidates (LD is measured from here).
+#csandcr: type of a CS+CR allele whose CR gap is not flanked by more gaps.
+#fallback: type of everything that is neither CS nor CR-only.
+#artifwt: gap-free alleles get their own type and count towards CR in HTR.
+#recomb: alleles in the known-allele catalog are typed 'recomb'.
+#unmatched: type of rows whose reference chunk is not in the reference ('unknown' rows are not counted)
+RULESETS = {
+    'a4': {'marker': "TCGCCGCAG", 'markeroffset': 0, 'csfrom': 24, 'csmin': 12, 'gapsfrom': 36,
+           'csandcr': 'other', 'fallback': 'other', 'artifwt': False, 'recomb': True, 'unmatched': 'insertion'},
+    'indivfin': {'marker': "GATCGCC", 'markeroffset': 4, 'csfrom': 0, 'csmin': 5, 'gapsfrom': 5,
+                 'csandcr': 'other', 'fallback': 'other', 'artifwt': False, 'recomb': False, 'unmatched': 'unknown'},
+    'adj': {'marker': "GATCGCC", 'markeroffset': 4, 'csfrom': 0, 'csmin': 5, 'gapsfrom': 5,
+            'csandcr': 'nhej', 'fallback': 'nhej', 'artifwt': True, 'recomb': False, 'unmatched': 'unknown'},
+    'extended': {'marker': "GATCGCC", 'markeroffset': 4, 'csfrom': 1, 'csmin': 12, 'gapsfrom': 13,
+                 'csandcr': 'other', 'fallback': 'other', 'artifwt': False, 'recomb': False, 'unmatched': 'unknown'},
+}
+
+
+def crwindow(refsequence, rules):
+    #(crdeletionstart, crdeletionend) of a rule set in refsequence
+    crdeletionstart = refsequence.find(rules['marker']) + len(rules['marker']) + rules['markeroffset']
+    return crdeletionstart, crdeletionstart + 3
+
+
+class Amplicon:
+    #one locus of a multi-amplicon run: its reference and rule set, plus everything derived from them
+    #(CR window, reference index, cache ids) computed once and shared by every sample routed to it
+    def __init__(self, name, refsequence, ruleset='a4', marker=None, markeroffset=None):
+        if ruleset not in RULESETS:
+            raise ValueError(f"amplicon {name!r}: unknown rule set {ruleset!r}")
+        self.name = name
+        self.refsequence = refsequence.strip().upper()
+        self.ruleset = ruleset
+        self.rules = dict(RULESETS[ruleset])
+        if marker is not None:
+            self.rules['marker'] = marker.upper()
+        if markeroffset is not None:
+            self.rules['markeroffset'] = int(markeroffset)
+        if self.rules['marker'] not in self.refsequence:
+            raise ValueError(f"amplicon {name!r}: cut-site marker {self.rules['marker']} not in its reference")
+        self.crdeletionstart, self.crdeletionend = crwindow(self.refsequence, self.rules)
+        self.refindex = RefIndex(self.refsequence)
+
+    def configid(self):
+        #everything that changes how a table is classified against this amplicon
+        return f"{self.name}:{self.ruleset}:{self.rules['marker']}:{self.rules['markeroffset']}:{self.refsequence}"
+
+
+def readamplicons(path):
+    #JSON list of {"name", "reference", optional "ruleset", "marker", "markeroffset"} -> [Amplicon]
+    with open(path, 'r') as f:
+        configs = json.load(f)
+    amplicons = [Amplicon(config['name'], config['reference'], config.get('ruleset', 'a4'), config.get('marker'), config.get('markeroffset'))
+                 for config in configs]
+    #pool jobs and results refer to amplicons by name
+    names = [amplicon.name for amplicon in amplicons]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"{path}: amplicon name(s) used more than once: {', '.join(duplicates)}")
+    return amplicons
+
+
+def routeamplicon(filename, amplicons, samplerows=500):
+    #the amplicon whose reference holds the most reads of the table's first samplerows rows, or None.
+    #reads the table itself: checking a columnar copy is fresh would hash the whole table for 500 rows
+    readsbyamplicon = [0] * len(amplicons)
+    for alignedseq, refseqinfile, reads, percentage in islice(readalleletable(filename, columnar=False), samplerows):
+        for i, amplicon in enumerate(amplicons):
+            if amplicon.refindex.find(refseqinfile) != -1:
+                readsbyamplicon[i] += reads
+    best = max(range(len(amplicons)), key=readsbyamplicon.__getitem__, default=None)
+    if best is None or readsbyamplicon[best] == 0:
+        return None
+    return amplicons[best]
+
+
+class ClassifyCache:
+    #bounded LRU of (alignedseq, refseqinfile, rulesetid) -> classifyrow() output.
+    #one per main() session so WT/CS/CR/common NHEJ alleles are classified once per plate.
+    #pool workers keep their own; their counts are merged in here so the summary covers the whole session
+    def __init__(self, maxsize=200000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.workerentries = {} #worker pid -> alleles in that worker's memo
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def merge(self, worker, hits, misses, entries):
+        self.hits += hits
+        self.misses += misses
+        self.workerentries[worker] = entries
+
+    def hitrate(self):
+        lookups = self.hits + self.misses
+        return (self.hits / lookups) * 100 if lookups else 0
+
+    def summary(self):
+        return f"{self.hits} hits / {self.misses} misses ({self.hitrate():.1f}% hit rate), {len(self.entries) + sum(self.workerentries.values())} alleles cached"
+
+
+def classifyrow(alignedseq, refseqinfile, refindex, crdeletionstart, crdeletionend, rules=RULESETS['a4'], catalog=KNOWNALLELES):
+    #(type, LDel, LDelstart, LDelend, ngapruns) for one allele
+    if rules['recomb'] and catalog.lookup(alignedseq) is not None:
+        return ('recomb', 0, -1, -1, 0)
+
+    #find first character, reference chunk
+    refstartinfull = refindex.find(refseqinfile)
+    if refstartinfull == -1:
+        return (rules['unmatched'], 0, -1, -1, 0)
+
+    return applyrules(alignedseq, crdeletionstart - refstartinfull, crdeletionend - refstartinfull, rules)
+
+
+def applyrules(alignedseq, startinaligned, endinaligned, rules):
+    #(type, LDel, LDelstart, LDelend, ngapruns) of an allele that matched the reference.
+    #startinaligned/endinaligned is the CR window in the aligned sequence. the checks are str methods
+    #and slices; the gap runs are only walked (gapsignature) for the rows that can end up nhej
+    csfrom = rules['csfrom']
+    gapsfrom = rules['gapsfrom']
+    seqlength = len(alignedseq)
+
+    #hyphens running on from csfrom
+    fromcs = alignedseq[csfrom:]
+    leadinghyphens = len(fromcs) - len(fromcs.lstrip('-'))
+
+    #'---' at the CR site
+    crdeletionpresent = (startinaligned >= 0 and endinaligned <= seqlength and
+                         alignedseq.count('-', startinaligned, endinaligned) == endinaligned - startinaligned)
+
+    LDel, LDelstart, LDelend, ngapruns = 0, -1, -1, 0
+    #allele type
+    if leadinghyphens >= rules['csmin']:
+
+        if '-' in alignedseq[gapsfrom:]:
+
+            LDel, LDelstart, LDelend, ngapruns = getLDrun(alignedseq, gapsfrom)
+
+            if crdeletionpresent:
+                #nhej if the CR gap carries on into the base before or after the window
+                beforeindex = startinaligned - 1
+                afterindex = endinaligned
+                if (beforeindex >= 0 and alignedseq[beforeindex] == '-') or (afterindex < seqlength and alignedseq[afterindex] == '-'):
+                    alleletype = 'nhej'
+                else:
+                    alleletype = rules['csandcr']
+            else:
+                alleletype = 'nhej'
+
         else:
-            currdel = 0
-    
-    return maxdel
+            #only CS, CS
+            alleletype = 'cs'
+    elif crdeletionpresent and alignedseq.count('-') == 3:
+        #CRonly,  CR
+        alleletype = 'cr'
+    elif rules['artifwt'] and '-' not in alignedseq:
+        #no gaps at all
+        alleletype = 'artifwt'
+    else:
+        #all other
+        alleletype = rules['fallback']
 
+    return (alleletype, LDel, LDelstart, LDelend, ngapruns)
 
-def classifyalleles(filename, refsequence):
-    cutsitemarker = "TCGCCGCAG" #"GATCGCC"
-    cutsiteindex = refsequence.find(cutsitemarker)
-    
-    crdeletionstart = cutsiteindex + len(cutsitemarker) #+ 4
-    crdeletionend = crdeletionstart + 3
-    
-    csreads = 0
-    crreads = 0
-    nhejreads = 0
-    otherreads = 0
-    insertionreads = 0
-    recombreads = 0
-    topsequences = []
-
-    RECOMBSEQ1 = "TTCCGGTGCCGGAAAGACGACCCT------------TGCCTTTCGATCGCCGCAG---ATCCAAGTATCGCCATCCGGGATGCGACTGCTCAATGGCCAACCTGTGGACG"
-    RECOMBSEQ2 = "TTCCGGTGCCGGAAAGACGACCCTGCTGAATGCCCTTGCCTTTCGATCGCCGCAGGGCATCCAAGTATCGCCATCCGGGATGCGACTGCTCAATGGCCAACCTGTGGACG"
-
-    NHEJList = [] #(allelesequence, maxDL, reads, percentage)
-    
-    with open(filename, 'r') as f:
-        header = next(f) 
-        for line in f:
-            parts = line.strip().split('\t')
-            if len(parts) < 8:
-                continue
-                
-            alignedseq = parts[0]
-            refseqinfile = parts[1]
-            reads = int(parts[6])
-            percentage = float(parts[7])
-            
-            topsequences.append({'alignedseq': alignedseq, 'reads': reads, 'percentage': percentage, 'type': 'unknown'})
-            
-            
-            
-            
-            if alignedseq == RECOMBSEQ1 or alignedseq == RECOMBSEQ2:
-                topsequences[-1]['type'] = 'recomb'
-                recombreads += reads
-                continue
-            
-            
-            
-            #find first character, reference chunk
-            refstartinfull = refsequence.find(refseqinfile) 
-            if refstartinfull == -1:
-                topsequences[-1]['type'] = 'insertion'
-                insertionreads += reads
-                continue
-                
-            startinaligned = crdeletionstart - refstartinfull
-            endinaligned = crdeletionend - refstartinfull
-            
 
-            deletionexistbefore12B = '-' in alignedseq[0:23]
 
-            leadinghyphens = 0
+def classifybatch(alignedseqs, refseqinfiles, refindex, crdeletionstart, crdeletionend, catalog=KNOWNALLELES, rules=RULESETS['a4']):
+    #same rules as classifyrow for a whole table at once, on a padded uint8 matrix (one row per allele).
+    #returns type codes into ALLELETYPES plus LDel, LDelstart, LDelend, ngapruns (see getLDrun), all arrays
+    nrows = len(alignedseqs)
+    if nrows == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return np.zeros(0, dtype=np.int8), empty, empty, empty, empty
+
+    csfrom = rules['csfrom']
+    gapsfrom = rules['gapsfrom']
+    matrix, lengths = seqmatrix(alignedseqs, max(csfrom, gapsfrom) + 1)
+    width = matrix.shape[1]
+    gaps = matrix == ord('-')
+    rows = np.arange(nrows)
+
+    recomb = np.zeros(nrows, dtype=bool)
+    if rules['recomb']:
+        lookup = catalog.lookup
+        recomb = np.fromiter((lookup(seq) is not None for seq in alignedseqs), dtype=bool, count=nrows)
+    refstartinfull = np.fromiter(map(refindex.find, refseqinfiles), dtype=np.int64, count=nrows)
+    unmatched = ~recomb & (refstartinfull == -1)
+
+    #leading hyphens from csfrom
+    nongapcs = ~gaps[:, csfrom:]
+    leadinghyphens = np.where(nongapcs.any(axis=1), nongapcs.argmax(axis=1), nongapcs.shape[1])
+
+    totalhyphens = gaps.sum(axis=1)
+    gapafter = gaps[:, gapsfrom:].any(axis=1)
+
+    #'---' window at the CR site, and whether the gap runs on past either side of it
+    startinaligned = crdeletionstart - refstartinfull
+    endinaligned = startinaligned + (crdeletionend - crdeletionstart)
+    inwindow = (startinaligned >= 0) & (endinaligned <= lengths)
+    crdeletionpresent = inwindow.copy()
+    for offset in range(crdeletionend - crdeletionstart):
+        crdeletionpresent &= gaps[rows, np.clip(startinaligned + offset, 0, width - 1)]
+    beforeindex = startinaligned - 1
+    afterindex = endinaligned
+    neighbourgap = ((beforeindex >= 0) & gaps[rows, np.clip(beforeindex, 0, width - 1)]) | \
+                   ((afterindex < lengths) & gaps[rows, np.clip(afterindex, 0, width - 1)])
+
+    csbranch = leadinghyphens >= rules['csmin']
+
+    #getLD and the rest of the gap-run descriptors, only for the rows that can end up nhej
+    ldrows = np.flatnonzero(csbranch & gapafter & ~unmatched & ~recomb)
+    LDel = np.zeros(nrows, dtype=np.int64)
+    LDelstart = np.full(nrows, -1, dtype=np.int64)
+    LDelend = np.full(nrows, -1, dtype=np.int64)
+    ngapruns = np.zeros(nrows, dtype=np.int64)
+    LDel[ldrows], LDelstart[ldrows], LDelend[ldrows], ngapruns[ldrows] = gaprunsbatch(gaps[ldrows, gapsfrom:], gapsfrom)
+
+    nhej = csbranch & gapafter & (~crdeletionpresent | neighbourgap)
+    csandcr = csbranch & gapafter & crdeletionpresent & ~neighbourgap
+    cs = csbranch & ~gapafter
+    cr = ~csbranch & crdeletionpresent & (totalhyphens == 3)
 
-            for char in alignedseq[24:]:
-                if char == '-':
-                    leadinghyphens += 1
+    typecodes = np.full(nrows, ALLELETYPES.index(rules['fallback']), dtype=np.int8)
+    if rules['artifwt']:
+        typecodes[totalhyphens == 0] = ALLELETYPES.index('artifwt')
+    typecodes[csandcr] = ALLELETYPES.index(rules['csandcr'])
+    typecodes[cs] = ALLELETYPES.index('cs')
+    typecodes[cr] = ALLELETYPES.index('cr')
+    typecodes[nhej] = ALLELETYPES.index('nhej')
+    typecodes[unmatched] = ALLELETYPES.index(rules['unmatched'])
+    typecodes[recomb] = ALLELETYPES.index('recomb')
+
+    return typecodes, LDel, LDelstart, LDelend, ngapruns
+
+
+def tableformat(filename):
+    #'zip', 'gz', 'parquet' or 'text' from the first bytes of the file
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic == b'PK\x03\x04':
+        return 'zip'
+    if magic[:2] == b'\x1f\x8b':
+        return 'gz'
+    if magic == b'PAR1':
+        return 'parquet'
+    return 'text'
+
+
+@contextmanager
+def openalleletable(filename):
+    #text handle on an allele table: plain .txt, CRISPResso's Alleles_frequency_table.zip or a .gz,
+    #told apart by their first bytes and decompressed as they are read
+    fmt = tableformat(filename)
+
+    if fmt == 'zip':
+        with zipfile.ZipFile(filename) as zf:
+            names = [name for name in zf.namelist() if not name.endswith('/')]
+            tables = [name for name in names if name.endswith('Alleles_frequency_table.txt')] or \
+                     [name for name in names if name.endswith('.txt')] or names
+            with zf.open(tables[0]) as raw:
+                yield io.TextIOWrapper(raw)
+    elif fmt == 'gz':
+        with gzip.open(filename, 'rt') as f:
+            yield f
+    else:
+        with open(filename, 'r') as f:
+            yield f
+
+
+TABLECOLUMNS = ('Aligned_Sequence', 'Reference_Sequence', '#Reads', '%Reads')
+#where CRISPResso2 puts them, for tables without a header
+DEFAULTCOLUMNS = (0, 1, 6, 7)
+SEQUENCECHARS = frozenset('ACGTN-')
+
+
+def tablecolumns(header):
+    #indices of TABLECOLUMNS in this table's header, or None if the first line is already an allele row
+    #(a header-less table, read at DEFAULTCOLUMNS). a header that doesn't name them all is a ValueError
+    names = [name.strip() for name in header.rstrip('\r\n').split('\t')]
+    if all(name in names for name in TABLECOLUMNS):
+        return tuple(names.index(name) for name in TABLECOLUMNS)
+    if not any(names) or (len(names) > max(DEFAULTCOLUMNS) and names[DEFAULTCOLUMNS[0]] and set(names[DEFAULTCOLUMNS[0]].upper()) <= SEQUENCECHARS
+                          and names[DEFAULTCOLUMNS[2]].isdigit()):
+        return None
+    missing = [name for name in TABLECOLUMNS if name not in names]
+    raise ValueError(f"allele table header has no {', '.join(missing)} column{'s' if len(missing) > 1 else ''}")
+
+
+MMAPRELEASEBYTES = 16 * 1024 * 1024
+
+
+def readalleletablemmap(filename, raw=False):
+    #plain tables: scan the memory-mapped file as bytes and decode only the two sequence fields
+    #(raw=True leaves them as bytes for classifybatch). not zero-copy: each line is copied out of the
+    #map into its own bytes objects. what it saves is the text decode of every field and, with the
+    #pages released as the scan passes them, the file itself sitting in memory; the rows a caller
+    #keeps still cost their own memory (batch=True keeps them all, chunkrows keeps one chunk)
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            columns = tablecolumns(mm.readline().decode('ascii', 'replace'))
+            if columns is None:
+                columns = DEFAULTCOLUMNS
+                mm.seek(0)
+            alignedcol, refcol, readscol, pctcol = columns
+            lastcol = max(alignedcol, refcol, readscol, pctcol)
+            stripseqs = lastcol in (alignedcol, refcol)
+            #mapped pages still count towards RSS once touched, so hand back the ones already scanned
+            canrelease = hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_DONTNEED')
+            released = 0
+            for line in iter(mm.readline, b''):
+                if canrelease and mm.tell() - released >= MMAPRELEASEBYTES:
+                    upto = mm.tell() - mm.tell() % mmap.PAGESIZE
+                    mm.madvise(mmap.MADV_DONTNEED, released, upto - released)
+                    released = upto
+                parts = line.split(b'\t', lastcol + 1)
+                if len(parts) <= lastcol:
+                    continue
+                if stripseqs:
+                    parts[lastcol] = parts[lastcol].rstrip()
+                if raw:
+                    yield parts[alignedcol], parts[refcol], int(parts[readscol]), float(parts[pctcol])
                 else:
+                    yield parts[alignedcol].decode('ascii'), parts[refcol].decode('ascii'), int(parts[readscol]), float(parts[pctcol])
+
+
+COLUMNARBATCHROWS = 65536
+
+
+#Parquet metadata key of the source table's size and sha1
+COLUMNARSOURCEKEY = b'findfreq.source'
+
+
+def filesha1(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def columnarpath(filename):
+    #where ingestalleletable() puts a table's columnar copy: next to it, its full name plus .parquet
+    #(t.txt and t.zip are different tables)
+    return filename + '.parquet'
+
+
+def sourcestamp(filename):
+    return {'size': os.path.getsize(filename), 'sha1': filesha1(filename)}
+
+
+def columnarcurrent(filename, parquetfile):
+    #whether a columnar copy was made from the table as it is now. mtimes don't tell (copies, restores),
+    #the content hash does; hashing is a fraction of the text parsing the copy saves
+    try:
+        stamp = json.loads((parquetfile.schema_arrow.metadata or {})[COLUMNARSOURCEKEY])
+        if stamp.get('size') != os.path.getsize(filename):
+            return False
+    except (KeyError, ValueError, OSError):
+        return False
+    return stamp.get('sha1') == filesha1(filename)
+
+
+def ingestalleletable(filename):
+    #convert a table once to Parquet (sequences dictionary-encoded, zstd) so later reads skip the text parsing.
+    #returns the .parquet path, or None without pyarrow. an up-to-date copy is left as it is
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    if tableformat(filename) == 'parquet':
+        return filename
+    path = columnarpath(filename)
+    if columnarrows(filename) is not None:
+        return path
+
+    seqtype = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema([('alignedseq', seqtype), ('refseqinfile', seqtype), ('reads', pa.int64()), ('percentage', pa.float64())],
+                       metadata={COLUMNARSOURCEKEY: json.dumps(sourcestamp(filename)).encode()})
+    rows = readalleletable(filename, columnar=False)
+    tmppath = path + f'.{os.getpid()}.tmp'
+    try:
+        with pq.ParquetWriter(tmppath, schema, compression='zstd') as writer:
+            while True:
+                block = list(islice(rows, COLUMNARBATCHROWS))
+                if not block:
                     break
+                alignedseqs, refseqinfiles, readslist, percentages = zip(*block)
+                writer.write_table(pa.table([pa.array(alignedseqs, pa.string()).dictionary_encode(), pa.array(refseqinfiles, pa.string()).dictionary_encode(),
+                                             pa.array(readslist, pa.int64()), pa.array(percentages, pa.float64())], schema=schema))
+    except BaseException:
+        #a table that can't be read leaves no half-written copy behind
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    os.replace(tmppath, path)
+    return path
 
-            crdeletionpresent = (startinaligned >= 0 and endinaligned <= len(alignedseq) and alignedseq[startinaligned:endinaligned] == '---')
-            
-            #cs/nhej/other starting is >5
-            totalhyphens = alignedseq.count('-')
-            
-            #allele type
-            if leadinghyphens >= 12:
 
-                remaining = alignedseq[36:]
-                if '-' in remaining:  
-                   
-                    LDel = getLD(alignedseq)
-        
-                    if crdeletionpresent:
-                        beforeindex = startinaligned - 1
-                        afterindex = endinaligned
-                        if (beforeindex >= 0 and alignedseq[beforeindex] == '-') or (afterindex < len(alignedseq) and alignedseq[afterindex] == '-'):
-                            topsequences[-1]['type'] = 'nhej'
-                            NHEJList.append((alignedseq, LDel, reads, percentage))  #Add once
-                        else:
-                            topsequences[-1]['type'] = 'other'
-                            # Don't add to NHEJList if it's 'other'
-                    else:
-                        topsequences[-1]['type'] = 'nhej'
-                        NHEJList.append((alignedseq, LDel, reads, percentage))
+def columnarrows(filename):
+    #rows of the table's columnar copy if there is one made from the table as it is now and pyarrow can read it, else None
+    #no copy, no pyarrow import and no hashing
+    if not os.path.exists(columnarpath(filename)):
+        return None
+    try:
+        import pyarrow.parquet as pq
+        parquetfile = pq.ParquetFile(columnarpath(filename))
+    except (OSError, ImportError, ValueError):
+        return None
+    if not columnarcurrent(filename, parquetfile):
+        return None
+    return readalleletableparquet(parquetfile)
 
 
-                else:
-                    #only CS, CS
-                    topsequences[-1]['type'] = 'cs'
-            elif crdeletionpresent and totalhyphens == 3:
-                #CRonly,  CR
-                topsequences[-1]['type'] = 'cr'
+def readalleletableparquet(parquetfile):
+    #batch by batch; dictionary-encoded columns come back with one str object per distinct sequence
+    for batch in parquetfile.iter_batches(batch_size=COLUMNARBATCHROWS, columns=['alignedseq', 'refseqinfile', 'reads', 'percentage']):
+        columns = []
+        for column in batch.columns:
+            if hasattr(column, 'dictionary'):
+                values = column.dictionary.to_pylist()
+                columns.append(map(values.__getitem__, column.indices.to_pylist()))
             else:
-                #all other
-                topsequences[-1]['type'] = 'other'
+                columns.append(column.to_pylist())
+        yield from zip(*columns)
 
 
+def readalleletable(filename, raw=False, columnar=True):
+    #(alignedseq, refseqinfile, reads, percentage) for each row of an Alleles_frequency_table.
+    #columns are looked up by name once; rows are only split as far as the last one needed.
+    #raw=True may hand back the sequences as bytes (plain tables only).
+    #an up-to-date columnar copy from ingestalleletable() is read instead of the table itself
+    fmt = tableformat(filename)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        yield from readalleletableparquet(pq.ParquetFile(filename))
+        return
+    rows = columnarrows(filename) if columnar else None
+    if rows is not None:
+        yield from rows
+        return
+    if fmt == 'text':
+        yield from readalleletablemmap(filename, raw)
+        return
+
+    with openalleletable(filename) as f:
+        header = next(f, '')
+        columns = tablecolumns(header)
+        if columns is None:
+            columns = DEFAULTCOLUMNS
+            f = chain([header], f)
+        alignedcol, refcol, readscol, pctcol = columns
+        lastcol = max(alignedcol, refcol, readscol, pctcol)
+        #int()/float() ignore the line ending, a sequence in the last column does not
+        stripseqs = lastcol in (alignedcol, refcol)
+        for line in f:
+            parts = line.split('\t', lastcol + 1)
+            if len(parts) <= lastcol:
+                continue
+            if stripseqs:
+                parts[lastcol] = parts[lastcol].rstrip()
+            yield parts[alignedcol], parts[refcol], int(parts[readscol]), float(parts[pctcol])
 
-            if topsequences[-1]['type'] == 'cs':
-                csreads += reads
-            if topsequences[-1]['type'] == 'other':
-                otherreads += reads
-            if topsequences[-1]['type'] == 'nhej':
-                nhejreads += reads
 
+class TopAlleles:
+    #the n highest-read rows of a table, kept in a bounded min-heap instead of sorting every row.
+    #ties keep the order rows were added in, same as a stable descending sort
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.rowindex = 0
 
+    def add(self, reads, item):
+        if self.n <= 0:
+            return
+        rank = (reads, -self.rowindex)
+        self.rowindex += 1
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, (rank, item))
+        elif rank > self.heap[0][0]:
+            #tables come sorted by reads, so past the first n rows this is rarely taken
+            heapq.heapreplace(self.heap, (rank, item))
 
-            if topsequences[-1]['type'] == 'cr':
-                crreads += reads
+    def items(self):
+        return [item for rank, item in sorted(self.heap, reverse=True)]
+
+
+#rough Python + NumPy footprint of one table row while its chunk is being classified
+ROWBYTES = 2560
+
+
+def chunkrowsforbudget(memorybudget):
+    #rows per chunk that keep a chunk under memorybudget bytes
+    return max(1000, int(memorybudget // ROWBYTES))
+
+
+def classifyalleles(filename, refsequence, refindex=None, cache=None, batch=False, topn=100, chunkrows=None, catalog=KNOWNALLELES, amplicon=None, rulesets=()):
+    #chunkrows streams the table through classifybatch in blocks of that many rows and keeps only
+    #the counters, the top-N rows, the top-N NHEJ alleles and a deletion-length histogram.
+    #an Amplicon replaces refsequence/refindex with its own reference, rule set and precomputed window.
+    #rulesets names more RULESETS to count in the same pass (result['rulesets'], RULESETNUMBERS only)
+    if amplicon is not None:
+        refsequence, refindex, rules = amplicon.refsequence, amplicon.refindex, amplicon.rules
+        crdeletionstart, crdeletionend = amplicon.crdeletionstart, amplicon.crdeletionend
+        rulesetid = f"{amplicon.configid()}:{catalog.fingerprint()}"
+    else:
+        if refindex is None:
+            refindex = RefIndex(refsequence)
+        rules = RULESETS['a4']
+        crdeletionstart, crdeletionend = crwindow(refsequence, rules)
+        #cache entries are only valid for the same rules against the same reference
+        rulesetid = f"a4:{refsequence}:{catalog.fingerprint()}"
+
+    readsbytype = dict.fromkeys(ALLELETYPES, 0)
+    #(name, rules, CR window, memo id, reads per type) of each compared rule set, on the same reference
+    compared = []
+    for name in rulesets:
+        if RULESETS[name]['marker'] not in refsequence:
+            raise ValueError(f"rule set {name!r}: cut-site marker {RULESETS[name]['marker']} not in the reference")
+        window = crwindow(refsequence, RULESETS[name])
+        compared.append((name, RULESETS[name], window, f"{name}:{window[0]}:{rulesetid}", dict.fromkeys(ALLELETYPES, 0)))
+    knownreads = {} #reads per known-allele label
+    recombcode = ALLELETYPES.index('recomb')
+    topsequences = TopAlleles(topn)
+
+    NHEJList = [] #Allele records of the nhej rows
+    nhejsummary = {}
+
+    def asstr(seq):
+        return seq.decode('ascii') if isinstance(seq, bytes) else seq
+
+    if chunkrows:
+        nhejtop = TopAlleles(topn)
+        size_dict = {}
+        nhejalleles = 0
+        nhejcode = ALLELETYPES.index('nhej')
+        rows = readalleletable(filename, raw=True)
+        while True:
+            block = list(islice(rows, chunkrows))
+            if not block:
+                break
+            alignedseqs, refseqinfiles, readslist, percentages = zip(*block)
+            del block
+            typecodes, LDels, LDelstarts, LDelends, ngapruns = classifybatch(alignedseqs, refseqinfiles, refindex, crdeletionstart, crdeletionend, catalog, rules)
+            readsarray = np.array(readslist, dtype=np.int64)
+            for i in np.flatnonzero(typecodes == recombcode).tolist():
+                tallyknown(knownreads, catalog, alignedseqs[i], readslist[i])
+
+            readsums = np.bincount(typecodes, weights=readsarray.astype(np.float64), minlength=len(ALLELETYPES))
+            for code, alleletype in enumerate(ALLELETYPES):
+                readsbytype[alleletype] += int(readsums[code])
+            for name, comparedrules, (comparedstart, comparedend), comparedid, comparedreads in compared:
+                comparedcodes = classifybatch(alignedseqs, refseqinfiles, refindex, comparedstart, comparedend, catalog, comparedrules)[0]
+                readsums = np.bincount(comparedcodes, weights=readsarray.astype(np.float64), minlength=len(ALLELETYPES))
+                for code, alleletype in enumerate(ALLELETYPES):
+                    comparedreads[alleletype] += int(readsums[code])
+
+            #a chunk can only contribute its own top n
+            for i in np.argsort(-readsarray, kind='stable')[:topn].tolist():
+                topsequences.add(readslist[i], (asstr(alignedseqs[i]), readslist[i], percentages[i], int(typecodes[i]),
+                                                  int(LDels[i]), int(LDelstarts[i]), int(LDelends[i]), int(ngapruns[i])))
+
+            nhejrows = np.flatnonzero(typecodes == nhejcode)
+            nhejalleles += len(nhejrows)
+            if len(nhejrows):
+                sizes, inverse = np.unique(LDels[nhejrows], return_inverse=True)
+                counts = np.bincount(inverse)
+                sizereads = np.bincount(inverse, weights=readsarray[nhejrows].astype(np.float64))
+                for size, count, sizeread in zip(sizes.tolist(), counts.tolist(), sizereads.tolist()):
+                    if size not in size_dict:
+                        size_dict[size] = {'count': 0, 'reads': 0}
+                    size_dict[size]['count'] += count
+                    size_dict[size]['reads'] += int(sizeread)
+                for i in nhejrows[np.argsort(-readsarray[nhejrows], kind='stable')][:topn].tolist():
+                    nhejtop.add(readslist[i], Allele(asstr(alignedseqs[i]), readslist[i], percentages[i], 'nhej',
+                                                     int(LDels[i]), int(LDelstarts[i]), int(LDelends[i]), int(ngapruns[i])))
+
+        NHEJList = nhejtop.items()
+        nhejsummary = {'nhejalleles': nhejalleles, 'nhejstats': histogramstats(size_dict) if nhejalleles else None}
+
+    elif batch:
+        alignedseqs = []
+        refseqinfiles = []
+        readslist = []
+        percentages = []
+        for alignedseq, refseqinfile, reads, percentage in readalleletable(filename, raw=True):
+            alignedseqs.append(alignedseq)
+            refseqinfiles.append(refseqinfile)
+            readslist.append(reads)
+            percentages.append(percentage)
+
+        typecodes, LDels, LDelstarts, LDelends, ngapruns = classifybatch(alignedseqs, refseqinfiles, refindex, crdeletionstart, crdeletionend, catalog, rules)
+        for i in np.flatnonzero(typecodes == recombcode).tolist():
+            tallyknown(knownreads, catalog, alignedseqs[i], readslist[i])
+        #per-type read sums
+        readsums = np.bincount(typecodes, weights=np.array(readslist, dtype=np.float64), minlength=len(ALLELETYPES))
+        for code, alleletype in enumerate(ALLELETYPES):
+            readsbytype[alleletype] = int(readsums[code])
+        for name, comparedrules, (comparedstart, comparedend), comparedid, comparedreads in compared:
+            comparedcodes = classifybatch(alignedseqs, refseqinfiles, refindex, comparedstart, comparedend, catalog, comparedrules)[0]
+            readsums = np.bincount(comparedcodes, weights=np.array(readslist, dtype=np.float64), minlength=len(ALLELETYPES))
+            for code, alleletype in enumerate(ALLELETYPES):
+                comparedreads[alleletype] = int(readsums[code])
+
+        #only the rows that are reported get decoded.
+        #stable order so equal read counts keep table order
+        for i in np.argsort(-np.array(readslist, dtype=np.int64), kind='stable')[:topn].tolist():
+            topsequences.add(readslist[i], (asstr(alignedseqs[i]), readslist[i], percentages[i], int(typecodes[i]),
+                                              int(LDels[i]), int(LDelstarts[i]), int(LDelends[i]), int(ngapruns[i])))
+        for i in np.flatnonzero(typecodes == ALLELETYPES.index('nhej')).tolist():
+            NHEJList.append(Allele(asstr(alignedseqs[i]), readslist[i], percentages[i], 'nhej',
+                                   int(LDels[i]), int(LDelstarts[i]), int(LDelends[i]), int(ngapruns[i])))
+
+    else:
+        for alignedseq, refseqinfile, reads, percentage in readalleletable(filename):
+            if cache is not None:
+                key = (alignedseq, refseqinfile, rulesetid)
+                classified = cache.get(key)
+                if classified is None:
+                    classified = classifyrow(alignedseq, refseqinfile, refindex, crdeletionstart, crdeletionend, rules, catalog)
+                    cache.put(key, classified)
+            else:
+                classified = classifyrow(alignedseq, refseqinfile, refindex, crdeletionstart, crdeletionend, rules, catalog)
+
+            alleletype, LDel, LDelstart, LDelend, ngapruns = classified[:5]
+            topsequences.add(reads, (alignedseq, reads, percentage, alleletype, LDel, LDelstart, LDelend, ngapruns))
+            readsbytype[alleletype] += reads
+            if alleletype == 'nhej':
+                NHEJList.append(Allele(alignedseq, reads, percentage, alleletype, LDel, LDelstart, LDelend, ngapruns))  #Add once
+            elif alleletype == 'recomb':
+                tallyknown(knownreads, catalog, alignedseq, reads)
+
+            for name, comparedrules, (comparedstart, comparedend), comparedid, comparedreads in compared:
+                classified = cache.get((alignedseq, refseqinfile, comparedid)) if cache is not None else None
+                if classified is None:
+                    classified = classifyrow(alignedseq, refseqinfile, refindex, comparedstart, comparedend, comparedrules, catalog)
+                    if cache is not None:
+                        cache.put((alignedseq, refseqinfile, comparedid), classified)
+                comparedreads[classified[0]] += reads
+
+    result = summariseresult(filename, readsbytype, topsequences.items(), NHEJList, rules, knownreads)
+    if amplicon is not None:
+        result['amplicon'] = amplicon.name
+    result.update(nhejsummary)
+    if compared:
+        #only the numbers; no top sequences or NHEJ alleles are kept for the compared rule sets
+        result['rulesets'] = {}
+        for name, comparedrules, window, comparedid, comparedreads in compared:
+            summary = summariseresult(filename, comparedreads, [], [], comparedrules)
+            result['rulesets'][name] = {field: summary[field] for field in RULESETNUMBERS if field in summary}
+    return result
+
+
+def tallyknown(knownreads, catalog, alignedseq, reads):
+    label = catalog.lookup(alignedseq)
+    knownreads[label] = knownreads.get(label, 0) + reads
+
+
+def summariseresult(filename, readsbytype, topsequences, NHEJList, rules, knownreads=None):
+    #the per-sample result dict from per-type read sums, the top rows (Allele fields), the NHEJ alleles
+    #and the reads per known-allele label
+    csreads = readsbytype['cs']
+    crreads = readsbytype['cr']
+    nhejreads = readsbytype['nhej']
+    otherreads = readsbytype['other']
+    insertionreads = readsbytype['insertion']
+    recombreads = readsbytype['recomb']
+    artifwtreads = readsbytype['artifwt']
 
     
-    #top 100
-    topsequences.sort(key=lambda x: x['reads'], reverse=True)
-    top100 = topsequences[:100]
-    
-    totalreads = csreads + crreads + otherreads + nhejreads
-    totalCORreads = csreads + crreads + nhejreads
+    #artifwt is 0 unless the rule set types gap-free alleles separately
+    totalreads = csreads + crreads + otherreads + nhejreads + artifwtreads
+    totalCORreads = csreads + crreads + nhejreads + artifwtreads
 
     cspercentage = (csreads / totalreads) * 100 if totalreads > 0 else 0
     crpercentage = (crreads / totalreads) * 100 if totalreads > 0 else 0
@@ -158,7 +1022,7 @@ def classifyalleles(filename, refsequence):
     nhejpercentagecorr = (nhejreads / totalCORreads) * 100 if totalCORreads else 0 
 
 
-    HTRpercentage = (crreads - (csreads + nhejreads)) / ( crreads + csreads + nhejreads) * 100
+    HTRpercentage = ((crreads + artifwtreads) - (csreads + nhejreads)) / totalCORreads * 100 if totalCORreads else 0
     # if HTRpercentage < 0:
     #     HTRpercentage = 0
 
@@ -166,7 +1030,7 @@ def classifyalleles(filename, refsequence):
     recombpercentage = (recombreads / totalreads) * 100 if totalreads > 0 else 0
 
     
-    return {
+    result = {
         'filename': os.path.basename(filename),
         'csreads': csreads, #good
         'cspercentage': cspercentage, #good
@@ -175,7 +1039,7 @@ def classifyalleles(filename, refsequence):
         'otherreads': otherreads, #good
         'otherpercentage': otherpercentage, #good
         'totalreads': totalreads, #good
-        'topsequences': top100, #good
+        'topsequences': [Allele(*row) for row in topsequences], #good
         'nhejreads': nhejreads, #good
         'nhejpercentage': nhejpercentage, #good
         'HTRpercentage': HTRpercentage, #good
@@ -187,133 +1051,300 @@ def classifyalleles(filename, refsequence):
         'insertionreads': insertionreads,
         'insertionpercentage': insertionpercentage,
         'recombreads': recombreads,
-        'recombpercentage': recombpercentage
+        'recombpercentage': recombpercentage,
+        'knownreads': knownreads or {}
         
     }
+    if rules['artifwt']:
+        result['artifwtreads'] = artifwtreads
+        result['artifwtpercentage'] = (artifwtreads / totalreads) * 100 if totalreads else 0
+    return result
 
 
-def generatehtmlreport(genotyperesults, outputfile):
-    allresults = []
-    for group in genotyperesults:
-        for result in group['samples']:
-            resultWithGroup = result.copy()
-            resultWithGroup['group'] = group['name']
-            allresults.append(resultWithGroup)
+class ResultCache:
+    #on-disk per-sample results keyed by table content + reference + classification rules + classifier variant.
+    #size+mtime of a path already hashed skips rehashing; oldest entries go once the folder passes maxbytes
+    def __init__(self, cachedir, maxbytes=500 * 1024 * 1024, refresh=False):
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.refresh = refresh
+        os.makedirs(cachedir, exist_ok=True)
+        self.indexpath = os.path.join(cachedir, 'index.json')
+        try:
+            with open(self.indexpath, 'r') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
 
-    #bar chart with error bars
-    groupNames = [group['name'] for group in genotyperesults]
-    
-    #means and stdev for each group/type
-    barChartData = {}
-    metrics = ['cspercentagecorr', 'nhejpercentagecorr', 'crpercentagecorr', 'HTRpercentage']
-    metricLabels = ['CS Corrected %', 'NHEJ Corrected %', 'CR Corrected %', 'HTR %']
-    
-    for group in genotyperesults:
-        groupName = group['name']
-        barChartData[groupName] = {}
-        
-        for metric in metrics:
-            values = [s[metric] for s in group['samples']]
-            if values:
-                barChartData[groupName][metric] = {
-                    'mean': statistics.mean(values),
-                    'stdev': statistics.stdev(values) if len(values) > 1 else 0
-                }
-            else:
-                barChartData[groupName][metric] = {
-                    'mean': 0,
-                    'stdev': 0
-                }
+    def contenthash(self, filename):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        known = self.index.get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        digest = filesha1(path)
+        self.index[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
 
-    htmlcontent = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Allele Frequency Report from CRISPResso Individual </title>
-        <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
-        <script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
-        <style>
-            body {{
+    def key(self, filename, refsequence, topn=100, catalog=KNOWNALLELES, amplicon=None, rulesets=()):
+        rules = amplicon.rules if amplicon is not None else RULESETS['a4']
+        parts = [self.contenthash(filename), refsequence, repr(sorted(rules.items())), CLASSIFIERVARIANT, str(topn), catalog.fingerprint()]
+        if amplicon is not None:
+            parts.append(amplicon.configid())
+        #compared rule sets are part of the result
+        parts.extend(f"{name}={sorted(RULESETS[name].items())!r}" for name in rulesets)
+        return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key + '.pkl.z')
+
+    def load(self, key):
+        if self.refresh:
+            return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                result = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        #recently used entries survive eviction longest
+        os.utime(self.path(key))
+        return result
+
+    def store(self, key, result):
+        tmppath = self.path(key) + f'.{os.getpid()}.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), 1))
+        os.replace(tmppath, self.path(key))
+
+    def save(self):
+        #drop index entries for files that are gone, then evict by total size
+        self.index = {path: known for path, known in self.index.items() if os.path.exists(path)}
+        with open(self.indexpath, 'w') as f:
+            json.dump(self.index, f)
+
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if name.endswith('.pkl.z'):
+                st = os.stat(os.path.join(self.cachedir, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            os.remove(os.path.join(self.cachedir, name))
+            total -= size
+
+
+workerstate = {}
+
+
+def initworker(refsequence, batch, cachedir=None, topn=100, chunkrows=None, catalog=KNOWNALLELES, amplicons=(), rulesets=()):
+    #each worker process keeps its own reference index and memo for every file it is handed,
+    #and its own copy of each amplicon's precomputed state
+    workerstate['refsequence'] = refsequence
+    workerstate['catalog'] = catalog
+    workerstate['amplicons'] = {amplicon.name: amplicon for amplicon in amplicons}
+    workerstate['chunkrows'] = chunkrows
+    workerstate['topn'] = topn
+    workerstate['refindex'] = RefIndex(refsequence)
+    workerstate['cache'] = ClassifyCache()
+    workerstate['batch'] = batch
+    workerstate['rulesets'] = rulesets
+    workerstate['resultcache'] = ResultCache(cachedir) if cachedir else None
+
+
+def compactresult(result, topnhej=100):
+    #what the report needs from a sample: NHEJ stats and the top NHEJ alleles instead of the full list
+    compact = dict(result)
+    NHEJList = result['NHEJList']
+    if 'nhejstats' not in result:
+        #chunked results already carry these, from every NHEJ allele rather than the kept ones
+        compact['nhejalleles'] = len(NHEJList)
+        compact['nhejstats'] = deletionstats(NHEJList) if NHEJList else None
+    compact['NHEJList'] = sorted(NHEJList, key=lambda allele: allele.reads, reverse=True)[:topnhej]
+    return compact
+
+
+def classifyworker(job):
+    #(compacted result or None, error or None, (pid, memo hits, memo misses, memo size) for the session's ClassifyCache).
+    #a table that can't be classified comes back as its error so the rest of the plate carries on
+    filename, cachekey, ampliconname = job
+    cache = workerstate['cache']
+    hits, misses = cache.hits, cache.misses
+    result, error = None, None
+    try:
+        result = classifyalleles(filename, workerstate['refsequence'], workerstate['refindex'], cache, workerstate['batch'], workerstate['topn'], workerstate['chunkrows'], workerstate['catalog'],
+                                 workerstate['amplicons'].get(ampliconname), workerstate['rulesets'])
+    except Exception as e:
+        error = sampleerror(e)
+    if result is not None:
+        if cachekey is not None:
+            workerstate['resultcache'].store(cachekey, result)
+        result = compactresult(result, workerstate['topn'])
+    return result, error, (os.getpid(), cache.hits - hits, cache.misses - misses, len(cache.entries))
+
+
+def sampleerror(e):
+    return f"{type(e).__name__}: {e}"
+
+
+def workerpool(workers, refsequence, batch=False, cachedir=None, topn=100, chunkrows=None, catalog=KNOWNALLELES, amplicons=(), rulesets=(), mp_context=None):
+    #a pool whose workers keep their reference index, memo and amplicons until it is shut down, for sessions
+    #that call classifyfiles() more than once (one per group, one per poll). None with fewer than two workers.
+    #mp_context picks the start method (default: the platform's)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=initworker,
+                               initargs=(refsequence, batch, cachedir, topn, chunkrows, catalog, tuple(amplicons), tuple(rulesets)))
+
+
+def classifyfiles(filenames, refsequence, workers=None, batch=False, refindex=None, cache=None, resultcache=None, topn=100, chunkrows=None, catalog=KNOWNALLELES, amplicons=None, pool=None, rulesets=()):
+    #classify every file over a process pool (workers=None -> one per CPU), results in filenames order.
+    #with a ResultCache, files seen before are loaded instead of reclassified.
+    #amplicons, if given, holds the Amplicon (or None for refsequence) of each file.
+    #rulesets are counted alongside in the same pass (see classifyalleles).
+    #a file that fails to classify is reported and its result is None
+    #pool is a workerpool() started with the same settings (and every amplicon used); it is left open
+    if amplicons is None:
+        amplicons = [None] * len(filenames)
+    results = [None] * len(filenames)
+    jobs = []
+    for i, (filename, amplicon) in enumerate(zip(filenames, amplicons)):
+        cachekey = None
+        if resultcache is not None:
+            try:
+                cachekey = resultcache.key(filename, refsequence, topn, catalog, amplicon, rulesets)
+            except OSError as e:
+                print(f"{filename}: {sampleerror(e)}, skipped")
+                continue
+            cached = resultcache.load(cachekey)
+            if cached is not None:
+                cached['filename'] = os.path.basename(filename)
+                results[i] = compactresult(cached, topn)
+                continue
+        jobs.append((i, filename, cachekey, amplicon))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+
+    if pool is None and workers <= 1:
+        if refindex is None:
+            refindex = RefIndex(refsequence)
+        for i, filename, cachekey, amplicon in jobs:
+            try:
+                result = classifyalleles(filename, refsequence, refindex, cache, batch, topn, chunkrows, catalog, amplicon, rulesets)
+            except Exception as e:
+                print(f"{filename}: {sampleerror(e)}, skipped")
+                continue
+            if cachekey is not None:
+                resultcache.store(cachekey, result)
+            results[i] = compactresult(result, topn)
+    elif jobs:
+        ownpool = pool is None
+        if ownpool:
+            cachedir = resultcache.cachedir if resultcache is not None else None
+            #each distinct amplicon is shipped to a worker once, jobs refer to it by name
+            used = list({amplicon.name: amplicon for amplicon in amplicons if amplicon is not None}.values())
+            pool = workerpool(workers, refsequence, batch, cachedir, topn, chunkrows, catalog, used, rulesets)
+        try:
+            for (i, filename, cachekey, amplicon), (result, error, counts) in zip(jobs, pool.map(classifyworker, [(filename, cachekey, amplicon.name if amplicon else None)
+                                                                                                                  for i, filename, cachekey, amplicon in jobs])):
+                results[i] = result
+                if error is not None:
+                    print(f"{filename}: {error}, skipped")
+                if cache is not None:
+                    cache.merge(*counts)
+        finally:
+            if ownpool:
+                pool.shutdown()
+
+    if resultcache is not None:
+        resultcache.save()
+    return results
+
+
+#shared by both report layouts
+REPORTCSS = """            body {
                 font-family: Lucida Console, monospace;
                 margin: 0.05;
                 padding: 16px;
                 background-color: #f5f5f5;
-            }}
-            .container {{
+            }
+            .container {
                 max-width: 1400px;
                 margin: 0 auto;
                 background-color: white;
                 padding: 20px;
                 border-radius: 8px;
                 box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
-            }}
-            h1, h2, h3 {{
+            }
+            h1, h2, h3 {
                 color: #333;
-            }}
-            .chart-container {{
+            }
+            .chart-container {
                 margin: 30px 0;
                 position: relative;
                 height: 500px;
-            }}
-            table {{
+            }
+            table {
                 width: 100%;
                 border-collapse: collapse;
                 margin: 20px 0;
                 font-size: 14px;
-            }}
-            th, td {{
+            }
+            th, td {
                 padding: 12px;
                 text-align: left;
                 border-bottom: 1px solid #ddd;
-            }}
-            th {{
+            }
+            th {
                 background-color: #f2f2f2;
                 font-weight: bold;
-            }}
-            tr:hover {{
+            }
+            tr:hover {
                 background-color: #f5f5f5;
-            }}
-            .summary {{
+            }
+            .summary {
                 background-color: #d3d3d3;
                 padding: 15px;
                 border-radius: 5px;
                 margin: 20px 0;
-            }}
-            .sequence-box {{
+            }
+            .sequence-box {
                 font-family: monospace;
                 background-color: #f9f9f9;
                 padding: 10px;
                 border-radius: 5px;
                 margin: 10px 0;
                 overflow-x: auto;
-            }}
-            .cs-seq {{
+            }
+            .cs-seq {
                 color: #415b76;
-            }}
-            .cr-seq {{
+            }
+            .cr-seq {
                 color: #c0392b;
-            }}
-            .nhej-seq {{
+            }
+            .nhej-seq {
                 color: #27ae60;
-            }}
-            .htr-seq {{
+            }
+            .htr-seq {
                 color: #f39c12;
-            }}
-            .other-seq {{
+            }
+            .other-seq {
                 color: #7f8c8d;
-            }}
-            .insertion-seq {{
+            }
+            .insertion-seq {
                 color: #8e44ad;
-            }}
-            .sample-section {{
+            }
+            .sample-section {
                 margin: 30px 0;
                 padding: 20px;
                 border: 1px solid #ddd;
                 border-radius: 5px;
-            }}
-            .collapsible {{
+            }
+            .collapsible {
                 background-color: #eee;
                 color: #444;
                 cursor: pointer;
@@ -324,17 +1355,162 @@ def generatehtmlreport(genotyperesults, outputfile):
                 outline: none;
                 font-size: 15px;
                 margin: 10px 0;
-            }}
-            .active, .collapsible:hover {{
+            }
+            .active, .collapsible:hover {
                 background-color: #ccc;
-            }}
-            .content {{
+            }
+            .content {
                 padding: 0 18px;
                 display: none;
                 overflow: hidden;
                 background-color: #f9f9f9;
-            }}
-        </style>
+            }
+"""
+
+#draws the group bar chart from barChartData, groupNames, metrics and metricLabels
+BARCHARTJS = """                // Define colors for each metric type
+                const metricColors = [
+                    'rgba(65, 91, 118, 0.7)',    // CS - blue
+                    'rgba(39, 174, 96, 0.7)',    // NHEJ - green
+                    'rgba(192, 57, 43, 0.7)',    // CR - red
+                    'rgba(243, 156, 18, 0.7)'    // HTR - orange
+                ];
+                
+                const borderColors = [
+                    'rgba(65, 91, 118, 1)',
+                    'rgba(39, 174, 96, 1)',
+                    'rgba(192, 57, 43, 1)',
+                    'rgba(243, 156, 18, 1)'
+                ];
+                
+                // Prepare datasets for bar chart
+                const datasets = [];
+                
+                metrics.forEach((metric, metricIndex) => {
+                    const data = [];
+                    const errorBars = [];
+                    
+                    groupNames.forEach(groupName => {
+                        if (barChartData[groupName] && barChartData[groupName][metric]) {
+                            data.push(barChartData[groupName][metric].mean);
+                            errorBars.push(barChartData[groupName][metric].stdev);
+                        } else {
+                            data.push(0);
+                            errorBars.push(0);
+                        }
+                    });
+                    
+                    datasets.push({
+                        label: metricLabels[metricIndex],
+                        data: data,
+                        backgroundColor: metricColors[metricIndex],
+                        borderColor: borderColors[metricIndex],
+                        borderWidth: 1,
+                        errorBars: errorBars
+                    });
+                });
+                
+                // Create bar chart
+                const barCtx = document.getElementById('barChart').getContext('2d');
+                new Chart(barCtx, {
+                    type: 'bar',
+                    data: {
+                        labels: groupNames,
+                        datasets: datasets
+                    },
+                    options: {
+                        responsive: true,
+                        maintainAspectRatio: false,
+                        scales: {
+                            x: {
+                                title: {
+                                    display: true,
+                                    text: 'Genotype Groups'
+                                }
+                            },
+                            y: {
+                                beginAtZero: true,
+                                max: 100,
+                                title: {
+                                    display: true,
+                                    text: 'Percentage'
+                                }
+                            }
+                        },
+                        plugins: {
+                            legend: {
+                                position: 'top'
+                            },
+                            tooltip: {
+                                callbacks: {
+                                    label: function(context) {
+                                        const datasetIndex = context.datasetIndex;
+                                        const groupIndex = context.dataIndex;
+                                        const mean = context.parsed.y;
+                                        const stdev = datasets[datasetIndex].errorBars[groupIndex];
+                                        return metricLabels[datasetIndex] + ': ' + mean.toFixed(2) + '% ± ' + stdev.toFixed(2) + '%';
+                                    }
+                                }
+                            }
+                        }
+                    }
+                });
+                
+"""
+
+
+def groupbarchart(genotyperesults):
+    #(group names, per-group mean/stdev of each metric, metrics, metric labels) for the Chart.js bar chart
+    groupNames = [group['name'] for group in genotyperesults]
+    
+    #means and stdev for each group/type
+    barChartData = {}
+    metrics = ['cspercentagecorr', 'nhejpercentagecorr', 'crpercentagecorr', 'HTRpercentage']
+    metricLabels = ['CS Corrected %', 'NHEJ Corrected %', 'CR Corrected %', 'HTR %']
+    
+    for group in genotyperesults:
+        groupName = group['name']
+        barChartData[groupName] = {}
+        
+        for metric in metrics:
+            values = [s[metric] for s in group['samples']]
+            if values:
+                barChartData[groupName][metric] = {
+                    'mean': statistics.mean(values),
+                    'stdev': statistics.stdev(values) if len(values) > 1 else 0
+                }
+            else:
+                barChartData[groupName][metric] = {
+                    'mean': 0,
+                    'stdev': 0
+                }
+
+    return groupNames, barChartData, metrics, metricLabels
+
+
+def writehtmlreport(genotyperesults, write, topn=100):
+    #emits the report section by section through write(), nothing is held as one big string
+    allresults = []
+    for group in genotyperesults:
+        for result in group['samples']:
+            resultWithGroup = result.copy()
+            resultWithGroup['group'] = group['name']
+            allresults.append(resultWithGroup)
+
+    #bar chart with error bars
+    groupNames, barChartData, metrics, metricLabels = groupbarchart(genotyperesults)
+
+    write(f"""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Allele Frequency Report from CRISPResso Individual </title>
+        <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+        <script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
+        <style>
+{REPORTCSS}        </style>
     </head>
     <body>
         <div class="container">
@@ -375,10 +1551,10 @@ def generatehtmlreport(genotyperesults, outputfile):
                     </tr>
                 </thead>
                 <tbody>
-    """   
+    """)
 
     for result in allresults:
-        htmlcontent += f"""
+        write(f"""
                     <tr>
                         <td>{result['group']}</td>
                         <td>{result['filename']}</td>
@@ -399,19 +1575,19 @@ def generatehtmlreport(genotyperesults, outputfile):
                         <td>{result['otherreads']}</td>
                         <td>{result['otherpercentage']:.2f}%</td>
                     </tr>
-        """
+        """)
 
-    htmlcontent += """
+    write(f"""
                 </tbody>
             </table>
             
-            <h2>Top 100 Sequences by Sample</h2>
-    """
+            <h2>Top {topn} Sequences by Sample</h2>
+    """)
         
     # Top sequences for each sample
     for result in allresults:
-        htmlcontent += f"""
-            <button class="collapsible">{result['group']} - {result['filename']} - Top 100 Sequences</button>
+        write(f"""
+            <button class="collapsible">{result['group']} - {result['filename']} - Top {len(result['topsequences'])} Sequences</button>
             <div class="content">
                 <table>
                     <thead>
@@ -423,28 +1599,28 @@ def generatehtmlreport(genotyperesults, outputfile):
                         </tr>
                     </thead>
                     <tbody>
-        """
+        """)
 
         for seq in result['topsequences']:
     
-            seqclass = f"{seq['type']}-seq"
-            htmlcontent += f"""
+            seqclass = f"{seq.type}-seq"
+            write(f"""
                         <tr>
-                            <td><span class="{seqclass}">{seq['type'].upper()}</span></td>
-                            <td class="sequence-box {seqclass}">{seq['alignedseq']}</td>
-                            <td>{seq['reads']}</td>
-                            <td>{seq['percentage']:.2f}%</td>
+                            <td><span class="{seqclass}">{seq.type.upper()}</span></td>
+                            <td class="sequence-box {seqclass}">{seq.alignedseq}</td>
+                            <td>{seq.reads}</td>
+                            <td>{seq.percentage:.2f}%</td>
                         </tr>
-            """
+            """)
 
-        htmlcontent += """
+        write("""
                     </tbody>
                 </table>
             </div>
-        """  
+        """)  
 
     # Add NHEJ Deletion Analysis Table
-    htmlcontent += """
+    write("""
             <h2>NHEJ Deletion Analysis</h2>
             <table>
                 <thead>
@@ -456,66 +1632,65 @@ def generatehtmlreport(genotyperesults, outputfile):
                         <th>Average Deletion Length (bp)</th>
                         <th>Median Deletion Length (bp)</th>
                         <th>Max Deletion Length (bp)</th>
+                        <th>Deletion Length SD (bp)</th>
+                        <th>P10-P90 Deletion Length (bp)</th>
                     </tr>
                 </thead>
                 <tbody>
-    """
-    
+    """)
+
+    #aggregate each sample's NHEJ alleles once, shared by the table and the histograms
+    nhejstats = []
     for result in allresults:
-        if 'NHEJList' in result and result['NHEJList']:
-            # Calculate statistics
-            all_lengths = [del_size for seq, del_size, reads, pct in result['NHEJList'] for _ in range(reads)]
-            avg_length = statistics.mean(all_lengths) if all_lengths else 0
-            median_length = statistics.median(all_lengths) if all_lengths else 0
-            max_length = max(all_lengths) if all_lengths else 0
-            
-            htmlcontent += f"""
+        if 'nhejstats' in result:
+            nhejstats.append(result['nhejstats'])
+        else:
+            nhejstats.append(deletionstats(result['NHEJList']) if result.get('NHEJList') else None)
+    
+    for result, stats in zip(allresults, nhejstats):
+        if stats and stats['reads'] > 0:
+            write(f"""
                     <tr>
-                        <tr>{result['group']}</td>
+                        <td>{result['group']}</td>
                         <td>{result['filename']}</td>
                         <td>{result['nhejreads']}</td>
-                        <td>{len(result['NHEJList'])}</td>
-                        <td>{avg_length:.1f}</td>
-                        <td>{median_length:.1f}</td>
-                        <td>{max_length}</td>
+                        <td>{result.get('nhejalleles', len(result['NHEJList']))}</td>
+                        <td>{stats['mean']:.1f}</td>
+                        <td>{stats['median']:.1f}</td>
+                        <td>{stats['max']}</td>
+                        <td>{stats['stdev']:.1f}</td>
+                        <td>{stats['p10']:.1f} - {stats['p90']:.1f}</td>
                     </tr>
-            """
+            """)
         else:
-            htmlcontent += f"""
+            write(f"""
                     <tr>
                         <td>{result['group']}</td>
                         <td>{result['filename']}</td>
-                        <td colspan="5">No NHEJ alleles detected</td>
+                        <td colspan="7">No NHEJ alleles detected</td>
                     </tr>
-            """
+            """)
     
-    htmlcontent += """
+    write("""
                 </tbody>
             </table>
-    """
+    """)
     
     # Add NHEJ histograms and top sequences for each sample
     for idx, result in enumerate(allresults):  # Use index for unique IDs
         if 'NHEJList' in result and result['NHEJList']:
-            # Prepare data for histogram
-            size_dict = {}
-            for seq, del_size, reads, pct in result['NHEJList']:
-                if del_size not in size_dict:
-                    size_dict[del_size] = {'count': 0, 'reads': 0}
-                size_dict[del_size]['count'] += 1
-                size_dict[del_size]['reads'] += reads
-            
-            sizes = sorted(size_dict.keys())
-            read_counts = [size_dict[s]['reads'] for s in sizes]
+            # Histogram data from the stats pass above
+            sizes = nhejstats[idx]['sizes']
+            read_counts = nhejstats[idx]['read_counts']
             
             # Sort NHEJList by reads for the table
-            sorted_nhej = sorted(result['NHEJList'], key=lambda x: x[2], reverse=True)
-            top_nhej = sorted_nhej[:100]
+            sorted_nhej = sorted(result['NHEJList'], key=lambda allele: allele.reads, reverse=True)
+            top_nhej = sorted_nhej[:topn]
             
             # Create a unique ID for this sample
             unique_id = f"{result['group']}_{result['filename']}_{idx}".replace('.', '_').replace(' ', '_').replace('-', '_')
             
-            htmlcontent += f"""
+            write(f"""
                 <div class="sample-section">
                     <h3>{result['group']} - {result['filename']}</h3>
                     
@@ -548,131 +1723,47 @@ def generatehtmlreport(genotyperesults, outputfile):
                                     <th>Reads</th>
                                     <th>Percentage</th>
                                     <th>Max Deletion (bp)</th>
+                                    <th>Max Deletion At</th>
+                                    <th>Gap Runs</th>
                                 </tr>
                             </thead>
                             <tbody>
-        """
+        """)
             
-            for seq, del_size, reads, pct in top_nhej:
-                htmlcontent += f"""
+            for allele in top_nhej:
+                write(f"""
                             <tr>
-                                <td class="sequence-box nhej-seq">{seq}</td>
-                                <td>{reads}</td>
-                                <td>{pct:.2f}%</td>
-                                <td>{del_size}</td>
+                                <td class="sequence-box nhej-seq">{allele.alignedseq}</td>
+                                <td>{allele.reads}</td>
+                                <td>{allele.percentage:.2f}%</td>
+                                <td>{allele.LDel}</td>
+                                <td>{allele.LDelstart}-{allele.LDelend}</td>
+                                <td>{allele.ngapruns}</td>
                             </tr>
-                """
+                """)
             
-            htmlcontent += """
+            write("""
                             </tbody>
                         </table>
                     </div>
                 </div>
-            """
+            """)
         else:
-            htmlcontent += f"""
+            write(f"""
                 <div class="sample-section">
                     <h3>{result['group']} - {result['filename']}</h3>
                     <p>No NHEJ alleles detected in this sample.</p>
                 </div>
-            """
+            """)
 
-    htmlcontent += f"""
+    write(f"""
             <script>
                 const barChartData = {json.dumps(barChartData)};
                 const groupNames = {json.dumps(groupNames)};
                 const metrics = {json.dumps(metrics)};
                 const metricLabels = {json.dumps(metricLabels)};
                 
-                // Define colors for each metric type
-                const metricColors = [
-                    'rgba(65, 91, 118, 0.7)',    // CS - blue
-                    'rgba(39, 174, 96, 0.7)',    // NHEJ - green
-                    'rgba(192, 57, 43, 0.7)',    // CR - red
-                    'rgba(243, 156, 18, 0.7)'    // HTR - orange
-                ];
-                
-                const borderColors = [
-                    'rgba(65, 91, 118, 1)',
-                    'rgba(39, 174, 96, 1)',
-                    'rgba(192, 57, 43, 1)',
-                    'rgba(243, 156, 18, 1)'
-                ];
-                
-                // Prepare datasets for bar chart
-                const datasets = [];
-                
-                metrics.forEach((metric, metricIndex) => {{
-                    const data = [];
-                    const errorBars = [];
-                    
-                    groupNames.forEach(groupName => {{
-                        if (barChartData[groupName] && barChartData[groupName][metric]) {{
-                            data.push(barChartData[groupName][metric].mean);
-                            errorBars.push(barChartData[groupName][metric].stdev);
-                        }} else {{
-                            data.push(0);
-                            errorBars.push(0);
-                        }}
-                    }});
-                    
-                    datasets.push({{
-                        label: metricLabels[metricIndex],
-                        data: data,
-                        backgroundColor: metricColors[metricIndex],
-                        borderColor: borderColors[metricIndex],
-                        borderWidth: 1,
-                        errorBars: errorBars
-                    }});
-                }});
-                
-                // Create bar chart
-                const barCtx = document.getElementById('barChart').getContext('2d');
-                new Chart(barCtx, {{
-                    type: 'bar',
-                    data: {{
-                        labels: groupNames,
-                        datasets: datasets
-                    }},
-                    options: {{
-                        responsive: true,
-                        maintainAspectRatio: false,
-                        scales: {{
-                            x: {{
-                                title: {{
-                                    display: true,
-                                    text: 'Genotype Groups'
-                                }}
-                            }},
-                            y: {{
-                                beginAtZero: true,
-                                max: 100,
-                                title: {{
-                                    display: true,
-                                    text: 'Percentage'
-                                }}
-                            }}
-                        }},
-                        plugins: {{
-                            legend: {{
-                                position: 'top'
-                            }},
-                            tooltip: {{
-                                callbacks: {{
-                                    label: function(context) {{
-                                        const datasetIndex = context.datasetIndex;
-                                        const groupIndex = context.dataIndex;
-                                        const mean = context.parsed.y;
-                                        const stdev = datasets[datasetIndex].errorBars[groupIndex];
-                                        return metricLabels[datasetIndex] + ': ' + mean.toFixed(2) + '% ± ' + stdev.toFixed(2) + '%';
-                                    }}
-                                }}
-                            }}
-                        }}
-                    }}
-                }});
-                
-                // Collapsible sections
+{BARCHARTJS}                // Collapsible sections
                 var coll = document.getElementsByClassName("collapsible");
                 var i;
                 
@@ -690,13 +1781,263 @@ def generatehtmlreport(genotyperesults, outputfile):
             </script>
         </body>
     </html>
-    """
+    """)
+
+
+#summary table columns of the payload report, in order
+REPORTCOLUMNS = [('totalreads', 'Total Reads'), ('totalCORreads', 'Total Corrected Reads'),
+                 ('csreads', 'CS Reads'), ('cspercentage', 'CS %'), ('cspercentagecorr', 'CS Corrected %'),
+                 ('nhejreads', 'NHEJ Reads'), ('nhejpercentage', 'NHEJ %'), ('nhejpercentagecorr', 'NHEJ Corrected %'),
+                 ('crreads', 'CR Reads'), ('crpercentage', 'CR %'), ('crpercentagecorr', 'CR Corrected %'), ('HTRpercentage', 'HTR %'),
+                 ('insertionreads', 'Insertion Reads'), ('insertionpercentage', 'Insertion %'),
+                 ('otherreads', 'Other Reads'), ('otherpercentage', 'Other %')]
+
+#renders the payload report: tables and histograms are built from the JSON the first time their section is opened
+PAYLOADJS = """
+                const report = JSON.parse(document.getElementById('payload').textContent);
+                const types = report.types;
+
+                function esc(text) {
+                    return String(text).replace(/[&<>"]/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}[c]));
+                }
+                function pct(value) {
+                    return value.toFixed(2) + '%';
+                }
+                function title(sample) {
+                    return esc(report.groups[sample.g] + ' - ' + sample.f);
+                }
+
+                // with fragments a sample's rows arrive from <fragments>/sample<i>.js, which calls reportfragment()
+                const waiting = {};
+                function withdetail(i, then) {
+                    const sample = report.samples[i];
+                    if (!report.fragments || sample.top) {
+                        then(sample);
+                        return;
+                    }
+                    if (!waiting[i]) {
+                        waiting[i] = [];
+                        const script = document.createElement('script');
+                        script.src = report.fragments + '/sample' + i + '.js';
+                        document.head.appendChild(script);
+                    }
+                    waiting[i].push(then);
+                }
+                window.reportfragment = function(i, detail) {
+                    Object.assign(report.samples[i], detail);
+                    (waiting[i] || []).forEach(then => then(report.samples[i]));
+                    delete waiting[i];
+                };
+
+                // a collapsible renders its content the first time it is opened
+                function collapsibles(parent, render) {
+                    parent.querySelectorAll('.collapsible').forEach(button => {
+                        button.addEventListener('click', function() {
+                            this.classList.toggle('active');
+                            const content = this.nextElementSibling;
+                            const opening = content.style.display !== 'block';
+                            content.style.display = opening ? 'block' : 'none';
+                            if (opening && !content.dataset.rendered) {
+                                content.dataset.rendered = '1';
+                                withdetail(this.dataset.sample, sample => render(sample, content));
+                            }
+                        });
+                    });
+                }
+
+                document.getElementById('counts').textContent = report.samples.length + ' files across ' + report.groups.length + ' groups.';
+
+                document.getElementById('percentages').innerHTML = report.samples.map(sample =>
+                    '<tr><td>' + esc(report.groups[sample.g]) + '</td><td>' + esc(sample.f) + '</td>' +
+                    sample.n.map((value, i) => '<td>' + (report.percent[i] ? pct(value) : value) + '</td>').join('') + '</tr>').join('');
+
+                const topsequences = document.getElementById('topsequences');
+                topsequences.innerHTML = report.samples.map((sample, i) =>
+                    '<button class="collapsible" data-sample="' + i + '">' + title(sample) + ' - Top ' + sample.ntop + ' Sequences</button><div class="content"></div>').join('');
+                collapsibles(topsequences, (sample, content) => {
+                    const seqs = sample.seqs || report.seqs;
+                    content.innerHTML = '<table><thead><tr><th>Type</th><th>Sequence</th><th>Reads</th><th>Percentage</th></tr></thead><tbody>' +
+                        sample.top.map(([seq, reads, percentage, type]) => {
+                            const seqclass = types[type] + '-seq';
+                            return '<tr><td><span class="' + seqclass + '">' + types[type].toUpperCase() + '</span></td><td class="sequence-box ' + seqclass + '">' +
+                                esc(seqs[seq]) + '</td><td>' + reads + '</td><td>' + pct(percentage) + '</td></tr>';
+                        }).join('') + '</tbody></table>';
+                });
+
+                document.getElementById('nhejtable').innerHTML = report.samples.map(sample => {
+                    const nhej = sample.nhej;
+                    if (!nhej) {
+                        return '<tr><td>' + esc(report.groups[sample.g]) + '</td><td>' + esc(sample.f) + '</td><td colspan="7">No NHEJ alleles detected</td></tr>';
+                    }
+                    return '<tr><td>' + esc(report.groups[sample.g]) + '</td><td>' + esc(sample.f) + '</td><td>' + nhej.reads + '</td><td>' + nhej.alleles + '</td><td>' +
+                        nhej.mean.toFixed(1) + '</td><td>' + nhej.median.toFixed(1) + '</td><td>' + nhej.max + '</td><td>' + nhej.stdev.toFixed(1) + '</td><td>' +
+                        nhej.p10.toFixed(1) + ' - ' + nhej.p90.toFixed(1) + '</td></tr>';
+                }).join('');
+
+                const nhejsamples = document.getElementById('nhejsamples');
+                nhejsamples.innerHTML = report.samples.map((sample, i) => sample.nhej ?
+                    '<div class="sample-section"><h3>' + title(sample) + '</h3><button class="collapsible" data-sample="' + i + '">NHEJ Deletion Lengths and Top ' +
+                    sample.nhej.ntop + ' Sequences</button><div class="content"></div></div>' :
+                    '<div class="sample-section"><h3>' + title(sample) + '</h3><p>No NHEJ alleles detected in this sample.</p></div>').join('');
+                collapsibles(nhejsamples, (sample, content) => {
+                    const seqs = sample.seqs || report.seqs;
+                    content.innerHTML = '<div style="height: 400px; margin: 20px 0;"></div><table><thead><tr><th>Sequence</th><th>Reads</th><th>Percentage</th>' +
+                        '<th>Max Deletion (bp)</th><th>Max Deletion At</th><th>Gap Runs</th></tr></thead><tbody>' +
+                        sample.nhejtop.map(([seq, reads, percentage, LDel, LDelstart, LDelend, ngapruns]) =>
+                            '<tr><td class="sequence-box nhej-seq">' + esc(seqs[seq]) + '</td><td>' + reads + '</td><td>' + pct(percentage) + '</td><td>' +
+                            LDel + '</td><td>' + LDelstart + '-' + LDelend + '</td><td>' + ngapruns + '</td></tr>').join('') + '</tbody></table>';
+                    Plotly.newPlot(content.firstChild, [{
+                        x: sample.sizes,
+                        y: sample.sizereads,
+                        type: 'bar',
+                        marker: { color: '#27ae60', opacity: 0.7 },
+                        name: 'NHEJ Deletions'
+                    }], {
+                        title: 'Distribution of NHEJ Deletion Lengths',
+                        xaxis: { title: 'Maximum Deletion Length (bp)', dtick: 1 },
+                        yaxis: { title: 'Number of Reads' },
+                        height: 400
+                    });
+                });
+
+                const barChartData = report.barChartData;
+                const groupNames = report.groups;
+                const metrics = report.metrics;
+                const metricLabels = report.metricLabels;
+"""
+
+
+def reportpayload(genotyperesults, topn=100, fragments=None):
+    #(payload, per-sample details): every result as compact JSON-ready data. each distinct sequence is stored once in a
+    #'seqs' list and rows refer to it by index; numbers only keep the precision the report shows.
+    #without fragments the details are merged into the payload's samples and share one 'seqs'. with fragments (the folder
+    #the fragment files go in) the payload keeps only what the index page shows and each detail carries its own 'seqs'
+    groupNames, barChartData, metrics, metricLabels = groupbarchart(genotyperesults)
+    sharedseqs = {}
+
+    samples = []
+    details = []
+    for groupnumber, group in enumerate(genotyperesults):
+        for result in group['samples']:
+            seqindex = {} if fragments else sharedseqs
+
+            def seqid(alignedseq):
+                if alignedseq not in seqindex:
+                    seqindex[alignedseq] = len(seqindex)
+                return seqindex[alignedseq]
+
+            sample = {'g': groupnumber, 'f': result['filename'],
+                      'n': [round(result[field], 4) for field, label in REPORTCOLUMNS],
+                      'ntop': len(result['topsequences']), 'nhej': None}
+            detail = {'top': [[seqid(seq.alignedseq), seq.reads, round(seq.percentage, 4), seq.typecode]
+                              for seq in result['topsequences']]}
+            stats = result['nhejstats'] if 'nhejstats' in result else (deletionstats(result['NHEJList']) if result.get('NHEJList') else None)
+            if result.get('NHEJList') and stats and stats['reads'] > 0:
+                top_nhej = sorted(result['NHEJList'], key=lambda allele: allele.reads, reverse=True)[:topn]
+                sample['nhej'] = {'reads': result['nhejreads'], 'alleles': result.get('nhejalleles', len(result['NHEJList'])),
+                                  'mean': stats['mean'], 'median': stats['median'], 'max': stats['max'], 'stdev': stats['stdev'],
+                                  'p10': stats['p10'], 'p90': stats['p90'], 'ntop': len(top_nhej)}
+                detail['nhejtop'] = [[seqid(allele.alignedseq), allele.reads, round(allele.percentage, 4),
+                                      allele.LDel, allele.LDelstart, allele.LDelend, allele.ngapruns] for allele in top_nhej]
+                detail['sizes'] = stats['sizes']
+                detail['sizereads'] = stats['read_counts']
+            if fragments:
+                detail['seqs'] = list(seqindex)
+            else:
+                sample.update(detail)
+            samples.append(sample)
+            details.append(detail)
+
+    payload = {'groups': groupNames, 'barChartData': barChartData, 'metrics': metrics, 'metricLabels': metricLabels,
+               'percent': ['percentage' in field for field, label in REPORTCOLUMNS], 'types': ALLELETYPES,
+               'seqs': list(sharedseqs), 'samples': samples, 'fragments': fragments}
+    return payload, details
+
+
+def writepayloadreport(genotyperesults, write, topn=100, fragments=None):
+    #the same report as writehtmlreport, but the data is embedded once as JSON and the page renders it in the browser:
+    #no per-sample markup or script blocks, and collapsed sections cost nothing until opened.
+    #with fragments the per-sample details are left out and returned for writefragments()
+    payload, details = reportpayload(genotyperesults, topn, fragments)
+    payload = json.dumps(payload, separators=(',', ':'))
+    write(f"""<!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Allele Frequency Report from CRISPResso Individual </title>
+        <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+        <script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
+        <style>
+{REPORTCSS}        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>Allele Frequency Report from CRISPResso Individual</h1>
+            <p id="counts"></p>
+
+            <h2>Corrected Percentages by Genotype</h2>
+            <div class="chart-container">
+                <canvas id="barChart"></canvas>
+            </div>
+
+            <h2>Percentages</h2>
+            <table>
+                <thead>
+                    <tr><th>Group</th><th>Filename</th>{''.join(f'<th>{label}</th>' for field, label in REPORTCOLUMNS)}</tr>
+                </thead>
+                <tbody id="percentages"></tbody>
+            </table>
+
+            <h2>Top {topn} Sequences by Sample</h2>
+            <div id="topsequences"></div>
+
+            <h2>NHEJ Deletion Analysis</h2>
+            <table>
+                <thead>
+                    <tr><th>Group</th><th>Filename</th><th>Total NHEJ Reads</th><th>Total NHEJ Allele Types</th><th>Average Deletion Length (bp)</th>
+                        <th>Median Deletion Length (bp)</th><th>Max Deletion Length (bp)</th><th>Deletion Length SD (bp)</th><th>P10-P90 Deletion Length (bp)</th></tr>
+                </thead>
+                <tbody id="nhejtable"></tbody>
+            </table>
+            <div id="nhejsamples"></div>
+        </div>
+        <script id="payload" type="application/json">""")
+    #'</' would end the script element early
+    write(payload.replace('</', '<\\/'))
+    write(f"""</script>
+        <script>{PAYLOADJS}{BARCHARTJS}        </script>
+    </body>
+    </html>
+    """)
+    return details if fragments else None
+
 
-    with open(outputfile, 'w') as f:
-        f.write(htmlcontent)
+def writefragments(details, folder):
+    #one sample<i>.js per sample. they are loaded as <script>s rather than fetched, which also works from file://
+    os.makedirs(folder, exist_ok=True)
+    for i, detail in enumerate(details):
+        with open(os.path.join(folder, f'sample{i}.js'), 'w') as f:
+            f.write(f"reportfragment({i}, {json.dumps(detail, separators=(',', ':'))});\n")
+
+
+def generatehtmlreport(genotyperesults, outputfile, topn=100, layout='inline'):
+    #layout 'inline' writes every table and chart as markup, 'payload' one JSON payload rendered in the browser,
+    #'fragments' a small index page plus <report>_files/sample<i>.js loaded when a sample's section is first opened
+    if layout == 'fragments':
+        folder = os.path.splitext(outputfile)[0] + '_files'
+        with open(outputfile, 'w', buffering=1 << 20) as f:
+            details = writepayloadreport(genotyperesults, f.write, topn, os.path.basename(folder))
+        writefragments(details, folder)
+        return outputfile
+    writer = writepayloadreport if layout == 'payload' else writehtmlreport
+    with open(outputfile, 'w', buffering=1 << 20) as f:
+        writer(genotyperesults, f.write, topn)
     return outputfile
 
 def generatemplchart(genotyperesults):
+    #only the interactive run draws this, so matplotlib is not imported for headless runs
+    import matplotlib.pyplot as plt
     
     groupnames = [group['name'] for group in genotyperesults]
     metrics = ['cspercentagecorr', 'nhejpercentagecorr', 'crpercentagecorr', 'HTRpercentage']
@@ -749,46 +2090,472 @@ def generatemplchart(genotyperesults):
     plt.show()
 
 
-def main():
+REFSEQUENCE = "TTGCGGCGTGGCCTATCCGGGCGAACTTTTGGCCGTGATGGGCAGTTCCGGTGCCGGAAAGACGACCCTGCTGAATGCCCTTGCCTTTCGATCGCCGCAGGGCATCCAAGTATCGCCATCCGGGATGCGACTGCTCAATGGCCAACCTGTGGACGCCAAGGAGATGCAGGCCAGGTGCGCCTATGTCCAGCAGGATGACCTCTTTATCGGCTCCCTAACGGCCAGGGAACACCTGATTTTCCAAGCCATGGTGCGGATGCCACGACATCTGACCTATCGGCAGCGAGTGGCCCGCGTGGATCAGGTGATCCAGGAGCTTTCGCTCAGCAAATGTCAGCACACGATCATCGGTGTGCCCGGCAGGGTGAAAGGTCTGTCCGGCGGAGAAAGG"
+
+SUMMARYFIELDS = ['group', 'filename', 'path', 'amplicon', 'totalreads', 'totalCORreads',
+                 'csreads', 'cspercentage', 'cspercentagecorr',
+                 'nhejreads', 'nhejpercentage', 'nhejpercentagecorr',
+                 'crreads', 'crpercentage', 'crpercentagecorr', 'HTRpercentage',
+                 'insertionreads', 'insertionpercentage', 'recombreads', 'recombpercentage',
+                 'otherreads', 'otherpercentage']
+
+
+RULESETFIELDS = ['group', 'filename', 'amplicon', 'ruleset', 'totalreads', 'totalCORreads',
+                 'cspercentage', 'cspercentagecorr', 'nhejpercentage', 'nhejpercentagecorr',
+                 'crpercentage', 'crpercentagecorr', 'HTRpercentage', 'otherpercentage', 'artifwtpercentage']
+#what classifyalleles() keeps per compared rule set
+RULESETNUMBERS = [field for field in RULESETFIELDS if field not in ('group', 'filename', 'amplicon', 'ruleset')]
+
+
+def printresult(filename, genotypename, eachresult):
+    print(f"file: {os.path.basename(filename)} for GROUP = {genotypename}" + (f" (amplicon {eachresult['amplicon']})" if eachresult.get('amplicon') else ""))
+    print(f" CS reads: {eachresult['csreads']}, CS %: {eachresult['cspercentage']:.2f}%")
+    print(f" CR reads: {eachresult['crreads']}, CR %: {eachresult['crpercentage']:.2f}%")
+    print(f" NHEJ reads: {eachresult['nhejreads']}, NHEJ %: {eachresult['nhejpercentage']:.2f}%")
+    print(f" Other reads: {eachresult['otherreads']}, Other %: {eachresult['otherpercentage']:.2f}%")
+    print(f" Total reads: {eachresult['totalreads']}")
+    print(f" HTR percentage: {eachresult['HTRpercentage']:.2f}%")
+    print(f" Corr CS %: {eachresult['cspercentagecorr']:.2f}%")
+    print(f" Corr CR %: {eachresult['crpercentagecorr']:.2f}%")
+    print(f" Corr NHEJ %: {eachresult['nhejpercentagecorr']:.2f}%")
+    print(f" Total Corr Reads: {eachresult['totalCORreads']:.2f}")
+    for label, reads in eachresult.get('knownreads', {}).items():
+        print(f" Known allele {label}: {reads} reads")
+
+
+def readsamplesheet(samplesheet):
+    #CSV or TSV with group, sample, path columns -> [(group, sample, path)] in sheet order.
+    #relative paths are taken from the sample sheet's folder
+    basedir = os.path.dirname(os.path.abspath(samplesheet))
+    with open(samplesheet, 'r', newline='') as f:
+        text = f.read()
+    dialect = sniffdialect(text)
+    rows = []
+    for row in csv.DictReader(text.splitlines(), dialect=dialect):
+        row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+        if not row.get('path'):
+            continue
+        path = os.path.normpath(os.path.join(basedir, os.path.expanduser(row['path'])))
+        rows.append((row.get('group') or 'ungrouped', row.get('sample') or os.path.basename(path), path))
+    return rows
+
+
+CRISPRESSOPREFIX = 'CRISPResso_on_'
+TABLENAMES = ['Alleles_frequency_table.txt', 'Alleles_frequency_table.zip', 'Alleles_frequency_table.txt.gz']
+#written by CRISPResso2 once a sample is finished
+CRISPRESSODONE = 'CRISPResso2_info.json'
+
+
+def scandir(path):
+    #(subfolders, filenames) of one folder; unreadable folders count as empty
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                else:
+                    files.append(entry.name)
+    except OSError:
+        pass
+    return subdirs, files
+
+
+def readplatemap(platemap):
+    #CSV/TSV with group and either sample or well columns -> [(group, sample or None, well or None)]
+    with open(platemap, 'r', newline='') as f:
+        text = f.read()
+    dialect = sniffdialect(text)
+    rules = []
+    for row in csv.DictReader(text.splitlines(), dialect=dialect):
+        row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+        if row.get('group') and (row.get('sample') or row.get('well')):
+            rules.append((row['group'], row.get('sample') or None, row.get('well') or None))
+    return rules
+
+
+def wellpattern(well):
+    #A1 / A01 as a standalone token in a sample name
+    match = re.fullmatch(r'([A-Pa-p])0*(\d{1,2})', well)
+    if not match:
+        return re.compile(r'(?<![A-Za-z0-9])' + re.escape(well) + r'(?![A-Za-z0-9])')
+    return re.compile(r'(?<![A-Za-z0-9])' + match.group(1) + r'0*' + match.group(2) + r'(?![0-9])', re.IGNORECASE)
+
+
+def assigngroup(sample, grouprules, platemaprules):
+    #plate map first (exact sample, then well), then the first matching NAME=REGEX rule
+    for group, mapsample, well in platemaprules:
+        if mapsample is not None and mapsample == sample:
+            return group
+    for group, mapsample, well in platemaprules:
+        if well is not None and wellpattern(well).search(sample):
+            return group
+    for group, pattern in grouprules:
+        if re.search(pattern, sample):
+            return group
+    return 'ungrouped'
+
+
+def discoversamples(root, grouprules=(), platemaprules=(), workers=16, complete=False):
+    #every CRISPResso_on_* folder under root with its allele table -> [(group, sample, path)].
+    #each level of the tree is listed concurrently, which is what makes network shares bearable.
+    #complete=True leaves out folders CRISPResso2 hasn't finished yet
+    found = []
+    level = [root]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while level:
+            nextlevel = []
+            for path, (subdirs, files) in zip(level, pool.map(scandir, level)):
+                if os.path.basename(path).startswith(CRISPRESSOPREFIX):
+                    if complete and CRISPRESSODONE not in files:
+                        continue
+                    for tablename in TABLENAMES:
+                        if tablename in files:
+                            found.append((os.path.basename(path)[len(CRISPRESSOPREFIX):], os.path.join(path, tablename)))
+                            break
+                    #a CRISPResso folder's own subfolders are plots and logs
+                    continue
+                nextlevel.extend(subdirs)
+            level = nextlevel
+
+    grouporder = [group for group, pattern in grouprules]
+    for group, sample, well in platemaprules:
+        if group not in grouporder:
+            grouporder.append(group)
+    samplerows = [(assigngroup(sample, grouprules, platemaprules), sample, path) for sample, path in found]
+
+    def naturalkey(text):
+        return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', text)]
+
+    samplerows.sort(key=lambda row: (grouporder.index(row[0]) if row[0] in grouporder else len(grouporder),
+                                     naturalkey(row[1]), row[2]))
+    return samplerows
+
+
+def writesummaries(genotyperesults, summaryprefix):
+    #per-sample numbers as <prefix>.csv and <prefix>.json
+    samples = []
+    for group in genotyperesults:
+        for result in group['samples']:
+            samples.append({field: group['name'] if field == 'group' else result.get(field) for field in SUMMARYFIELDS})
+
+    with open(summaryprefix + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARYFIELDS)
+        writer.writeheader()
+        writer.writerows(samples)
+    with open(summaryprefix + '.json', 'w') as f:
+        json.dump(samples, f, indent=1)
+    return [summaryprefix + '.csv', summaryprefix + '.json']
+
+
+def comparerulesets(genotyperesults, rulesets, summaryprefix):
+    #<prefix>.rulesets.csv: one row per sample and rule set, from the counts classifyalleles() took
+    #in the same pass as the sample's own classification
+    rows = []
+    for group in genotyperesults:
+        for result in group['samples']:
+            for name in rulesets:
+                row = dict(result['rulesets'][name], group=group['name'], filename=result.get('filename'), amplicon=result.get('amplicon'), ruleset=name)
+                rows.append({field: row.get(field) for field in RULESETFIELDS})
+
+    with open(summaryprefix + '.rulesets.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RULESETFIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return summaryprefix + '.rulesets.csv'
+
+
+def routesamples(samplerows, amplicons):
+    #(routed sample rows, their amplicons); samples matching no amplicon are reported and left out
+    routedrows = []
+    routed = []
+    for group, sample, path in samplerows:
+        try:
+            amplicon = routeamplicon(path, amplicons)
+        except Exception as e:
+            print(f"{sample}: {sampleerror(e)}, skipped")
+            continue
+        if amplicon is None:
+            print(f"{sample}: matches none of the amplicons, skipped")
+            continue
+        routedrows.append((group, sample, path))
+        routed.append(amplicon)
+    return routedrows, routed
+
+
+def ingestsample(path):
+    #ingestalleletable() for ingestsamples(); a table that can't be converted is reported and left as text
+    try:
+        return ingestalleletable(path)
+    except Exception as e:
+        print(f"{path}: {sampleerror(e)}, not ingested")
+        return path
+
+
+def ingestsamples(samplerows, workers=None):
+    #columnar copies of every sample table, over a process pool; False if pyarrow isn't there
+    paths = [path for group, sample, path in samplerows]
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    if workers <= 1:
+        ingested = [ingestsample(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            ingested = list(pool.map(ingestsample, paths))
+    return all(path is not None for path in ingested)
+
+
+STOREFIELDS = [field for field in SUMMARYFIELDS if field not in ('group', 'filename', 'path', 'amplicon')]
+
+
+class ResultsStore:
+    #every run's per-sample numbers and kept alleles (top sequences and top NHEJ alleles) in one SQLite file,
+    #indexed by run, group, sample and allele sequence so plates can be compared across runs without the raw tables.
+    #alleles are stored per list ('top'/'nhej') and rank: rows of one table can share an aligned sequence
+    #(different reference chunks), so the sequence alone doesn't identify one
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started TEXT, source TEXT, label TEXT);
+        CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, run INTEGER REFERENCES runs(id), grp TEXT, sample TEXT, path TEXT, amplicon TEXT,
+                                            {', '.join(field + (' INTEGER' if field.endswith('reads') else ' REAL') for field in STOREFIELDS)});
+        CREATE TABLE IF NOT EXISTS sequences (id INTEGER PRIMARY KEY, sequence TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS alleles (sample INTEGER REFERENCES samples(id), kept TEXT, rank INTEGER, sequence INTEGER REFERENCES sequences(id),
+                                            reads INTEGER, percentage REAL, type TEXT, LDel INTEGER, LDelstart INTEGER, LDelend INTEGER, ngapruns INTEGER,
+                                            PRIMARY KEY (sample, kept, rank)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS samples_run ON samples(run);
+        CREATE INDEX IF NOT EXISTS samples_grp ON samples(grp, run);
+        CREATE INDEX IF NOT EXISTS samples_sample ON samples(sample, run);
+        CREATE INDEX IF NOT EXISTS alleles_sequence ON alleles(sequence);
+    """
+
+    def __init__(self, dbpath):
+        self.db = sqlite3.connect(dbpath)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def sequenceid(self, alignedseq):
+        self.db.execute("INSERT OR IGNORE INTO sequences (sequence) VALUES (?)", (alignedseq,))
+        return self.db.execute("SELECT id FROM sequences WHERE sequence = ?", (alignedseq,)).fetchone()[0]
+
+    def addrun(self, genotyperesults, source, label=None):
+        #one transaction per run; returns the run id
+        with self.db:
+            run = self.db.execute("INSERT INTO runs (started, source, label) VALUES (?, ?, ?)",
+                                  (datetime.now().isoformat(timespec='seconds'), source, label)).lastrowid
+            for group in genotyperesults:
+                for result in group['samples']:
+                    sampleid = self.db.execute(f"INSERT INTO samples (run, grp, sample, path, amplicon, {', '.join(STOREFIELDS)}) "
+                                               f"VALUES ({', '.join('?' * (5 + len(STOREFIELDS)))})",
+                                               [run, group['name'], result.get('filename'), result.get('path'), result.get('amplicon')] +
+                                               [result.get(field) for field in STOREFIELDS]).lastrowid
+                    for kept, alleles in (('top', result['topsequences']), ('nhej', result['NHEJList'])):
+                        self.db.executemany("INSERT INTO alleles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                            [(sampleid, kept, rank, self.sequenceid(allele.alignedseq), allele.reads, allele.percentage, allele.type,
+                                              allele.LDel, allele.LDelstart, allele.LDelend, allele.ngapruns) for rank, allele in enumerate(alleles)])
+        return run
+
+    def groupvalues(self, group, field='crpercentage'):
+        #[(run, started, label, sample, value)] of one summary field for a group across every run
+        if field not in STOREFIELDS:
+            raise ValueError(f"unknown field {field!r} (expected one of {', '.join(STOREFIELDS)})")
+        return self.db.execute(f"SELECT runs.id, runs.started, runs.label, samples.sample, samples.{field} FROM samples JOIN runs ON runs.id = samples.run "
+                               "WHERE samples.grp = ? ORDER BY runs.id, samples.id", (group,)).fetchall()
+
+    def samplescontaining(self, alignedseq):
+        #[(run, started, group, sample, reads, percentage, type)] of every stored sample that kept this allele.
+        #a row kept both as a top sequence and as an NHEJ allele is listed once: the nhej rows are paired with
+        #equal top rows occurrence by occurrence, so distinct rows that happen to tie all stay listed
+        return self.db.execute("WITH kept AS (SELECT alleles.sample, alleles.kept, alleles.rank, alleles.reads, alleles.percentage, alleles.type, "
+                               "ROW_NUMBER() OVER (PARTITION BY alleles.sample, alleles.kept, alleles.reads, alleles.percentage, alleles.type ORDER BY alleles.rank) AS occurrence "
+                               "FROM sequences JOIN alleles ON alleles.sequence = sequences.id WHERE sequences.sequence = ?) "
+                               "SELECT runs.id, runs.started, samples.grp, samples.sample, kept.reads, kept.percentage, kept.type "
+                               "FROM kept JOIN samples ON samples.id = kept.sample JOIN runs ON runs.id = samples.run "
+                               "WHERE kept.kept = 'top' OR NOT EXISTS (SELECT 1 FROM kept AS top WHERE top.kept = 'top' AND top.sample = kept.sample "
+                               "AND top.reads = kept.reads AND top.percentage = kept.percentage AND top.type = kept.type AND top.occurrence = kept.occurrence) "
+                               "ORDER BY runs.id, samples.id, kept.kept DESC, kept.rank", (alignedseq,)).fetchall()
+
+
+def argchunkrows(args):
+    return chunkrowsforbudget(args.memory_budget * 1024 * 1024) if args.memory_budget else None
+
+
+def classifysamples(args, samplerows, resultcache=None, cache=None, pool=None):
+    #(sample rows, results) of a headless run: optional ingestion and amplicon routing, then the pool.
+    #rows that match no amplicon or fail to classify are left out of the returned rows
+    if args.ingest and not ingestsamples(samplerows, args.workers):
+        print("pyarrow is not installed, reading the text tables")
+    amplicons = None
+    if args.amplicons:
+        samplerows, amplicons = routesamples(samplerows, args.amplicons)
+    results = classifyfiles([path for group, sample, path in samplerows], REFSEQUENCE, workers=args.workers, batch=args.batch, cache=cache, resultcache=resultcache, topn=args.top,
+                            chunkrows=argchunkrows(args), catalog=args.catalog, amplicons=amplicons, pool=pool, rulesets=args.rulesets or ())
+    classified = [(row, eachresult) for row, eachresult in zip(samplerows, results) if eachresult is not None]
+    for (group, sample, path), eachresult in classified:
+        eachresult['filename'] = sample
+        eachresult['path'] = path
+        if not args.quiet:
+            printresult(sample, group, eachresult)
+    return [row for row, eachresult in classified], [eachresult for row, eachresult in classified]
+
+
+def groupsamples(samplerows, results):
+    #[{'name': group, 'samples': [result, ...]}] in first-seen group order
+    genotyperesults = []
+    groupindex = {}
+    for (group, sample, path), eachresult in zip(samplerows, results):
+        if group not in groupindex:
+            groupindex[group] = len(genotyperesults)
+            genotyperesults.append({'name': group, 'samples': []})
+        genotyperesults[groupindex[group]]['samples'].append(eachresult)
+    return genotyperesults
+
+
+def writeoutputs(args, genotyperesults):
+    #the HTML report and the summaries; returns the summary prefix
+    reportpath = generatehtmlreport(genotyperesults, args.output, args.top, args.report)
+    print(f"\nPath =  {reportpath}")
+    summaryprefix = args.summary or os.path.splitext(args.output)[0]
+    for summarypath in writesummaries(genotyperesults, summaryprefix):
+        print(f"Summary = {summarypath}")
+    return summaryprefix
+
+
+def finishrun(args, genotyperesults, summaryprefix, source):
+    #the once-per-run extras: the rule-set comparison and the results database
+    if args.rulesets:
+        print(f"Rule sets = {comparerulesets(genotyperesults, args.rulesets, summaryprefix)}")
+    if args.db:
+        store = ResultsStore(args.db)
+        print(f"Stored as run {store.addrun(genotyperesults, source, args.label)} in {args.db}")
+        store.close()
+
+
+def runsamples(args, samplerows, source):
+    #headless: no tkinter, no matplotlib, no browser
+    resultcache = None if args.no_cache else ResultCache(args.cachedir, args.cache_size * 1024 * 1024, args.refresh)
+    cache = ClassifyCache()
+    samplerows, results = classifysamples(args, samplerows, resultcache, cache)
+    if cache.hits + cache.misses and not args.quiet:
+        print(f"\nClassification cache: {cache.summary()}")
+    genotyperesults = groupsamples(samplerows, results)
+
+    if not genotyperesults:
+        print(f"No samples found in {source}")
+        return 1
+
+    summaryprefix = writeoutputs(args, genotyperesults)
+    finishrun(args, genotyperesults, summaryprefix, source)
+    return 0
+
+
+def watchsamples(args, grouprules, platemaprules):
+    #poll args.watch and classify each CRISPResso folder as soon as CRISPResso2 marks it finished. the report and
+    #summaries are rewritten after every poll that found new samples, so they are current seconds after the last one.
+    #stops after --expect samples or on Ctrl-C; the rule-set comparison and --db run once at the end.
+    #one pool and memo serve every poll
+    resultcache = None if args.no_cache else ResultCache(args.cachedir, args.cache_size * 1024 * 1024, args.refresh)
+    cache = ClassifyCache()
+    pool = workerpool(args.workers, REFSEQUENCE, args.batch, resultcache.cachedir if resultcache is not None else None, args.top, argchunkrows(args), args.catalog, args.amplicons or (), args.rulesets or ())
+    classified = {} #table path -> result, or None for a table that matched no amplicon or failed (not retried)
+    samplerows = []
+    print(f"Watching {args.watch} every {args.interval:g}s (Ctrl-C to stop)")
+    try:
+        while True:
+            samplerows = discoversamples(args.watch, grouprules, platemaprules, args.scan_workers, complete=True)
+            newrows = [row for row in samplerows if row[2] not in classified]
+            if newrows:
+                routedrows, results = classifysamples(args, newrows, resultcache, cache, pool)
+                for row in newrows:
+                    classified[row[2]] = None
+                for row, eachresult in zip(routedrows, results):
+                    classified[row[2]] = eachresult
+                done = [row for row in samplerows if classified[row[2]] is not None]
+                writeoutputs(args, groupsamples(done, [classified[row[2]] for row in done]))
+                print(f"{len(done)} samples classified, {len(routedrows)} new")
+            if args.expect and sum(entry is not None for entry in classified.values()) >= args.expect:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if cache.hits + cache.misses and not args.quiet:
+        print(f"\nClassification cache: {cache.summary()}")
+    if resultcache is not None:
+        resultcache.save()
+    done = [row for row in samplerows if classified.get(row[2]) is not None]
+    if not done:
+        print(f"No finished samples found in {args.watch}")
+        return 1
+    genotyperesults = groupsamples(done, [classified[row[2]] for row in done])
+    finishrun(args, genotyperesults, args.summary or os.path.splitext(args.output)[0], args.watch)
+    return 0
+
+
+def runqueries(args):
+    #answer --query-group / --query-allele from the results database alone
+    store = ResultsStore(args.db)
+    if args.query_group:
+        for run, started, label, sample, value in store.groupvalues(args.query_group, args.field):
+            print(f"run {run} ({started}{', ' + label if label else ''})\t{sample}\t{args.field} = {value}")
+    if args.query_allele:
+        for run, started, group, sample, reads, percentage, alleletype in store.samplescontaining(args.query_allele.strip().upper()):
+            print(f"run {run} ({started})\t{group}\t{sample}\t{reads} reads ({percentage:.2f}%), {alleletype}")
+    store.close()
+    return 0
+
+
+def rundialogs(resultcache=None, topn=100, catalog=KNOWNALLELES, workers=None, batch=False, chunkrows=None):
+    import tkinter as tk
+    from tkinter import filedialog, simpledialog
+    import webbrowser
+
     root = tk.Tk()
     root.withdraw()
     #window will open
     #refsequence defined for for finding positions afterwards.
-    refsequence = "TTGCGGCGTGGCCTATCCGGGCGAACTTTTGGCCGTGATGGGCAGTTCCGGTGCCGGAAAGACGACCCTGCTGAATGCCCTTGCCTTTCGATCGCCGCAGGGCATCCAAGTATCGCCATCCGGGATGCGACTGCTCAATGGCCAACCTGTGGACGCCAAGGAGATGCAGGCCAGGTGCGCCTATGTCCAGCAGGATGACCTCTTTATCGGCTCCCTAACGGCCAGGGAACACCTGATTTTCCAAGCCATGGTGCGGATGCCACGACATCTGACCTATCGGCAGCGAGTGGCCCGCGTGGATCAGGTGATCCAGGAGCTTTCGCTCAGCAAATGTCAGCACACGATCATCGGTGTGCCCGGCAGGGTGAAAGGTCTGTCCGGCGGAGAAAGG"
+    refsequence = REFSEQUENCE
     
+    refindex = RefIndex(refsequence)
+    cache = ClassifyCache()
+    #the workers (and their memo) outlive each group
+    pool = workerpool(workers, refsequence, batch, resultcache.cachedir if resultcache is not None else None, topn, chunkrows, catalog)
     genotyperesults = []
 
     #while window is open:
-    while True:
-        genotypename = simpledialog.askstring("Group", "Name/Cancel:")
-        if genotypename is None:
-            break
-        filenames = filedialog.askopenfilenames(title=f"select .txt Files for {genotypename}", filetypes=[("Text files", "*.txt")])
-        if not filenames:
-            continue
-        
-        genotypesamplelist = []
-        
-        for filename in filenames:
-            print(f"file: {os.path.basename(filename)} for GROUP = {genotypename}")
-            eachresult = classifyalleles(filename, refsequence)
-            genotypesamplelist.append(eachresult)
-            print(f" CS reads: {eachresult['csreads']}, CS %: {eachresult['cspercentage']:.2f}%")
-            print(f" CR reads: {eachresult['crreads']}, CR %: {eachresult['crpercentage']:.2f}%")
-            print(f" NHEJ reads: {eachresult['nhejreads']}, NHEJ %: {eachresult['nhejpercentage']:.2f}%")
-            print(f" Other reads: {eachresult['otherreads']}, Other %: {eachresult['otherpercentage']:.2f}%")
-            print(f" Total reads: {eachresult['totalreads']}")
-            print(f" HTR percentage: {eachresult['HTRpercentage']:.2f}%")
-            print(f" Corr CS %: {eachresult['cspercentagecorr']:.2f}%")
-            print(f" Corr CR %: {eachresult['crpercentagecorr']:.2f}%")
-            print(f" Corr NHEJ %: {eachresult['nhejpercentagecorr']:.2f}%")
-            print(f" Total Corr Reads: {eachresult['totalCORreads']:.2f}")
-        
-        genotyperesults.append({
-            'name': genotypename,
-            'samples': genotypesamplelist
-        })
-    
+    try:
+        while True:
+            genotypename = simpledialog.askstring("Group", "Name/Cancel:")
+            if genotypename is None:
+                break
+            filenames = filedialog.askopenfilenames(title=f"select .txt Files for {genotypename}", filetypes=[("Allele tables", "*.txt *.zip *.gz"), ("Text files", "*.txt"), ("Zipped tables", "*.zip *.gz")])
+            if not filenames:
+                continue
+
+            genotypesamplelist = classifyfiles(list(filenames), refsequence, workers=workers, batch=batch, refindex=refindex, cache=cache, resultcache=resultcache, topn=topn,
+                                              chunkrows=chunkrows, catalog=catalog, pool=pool)
+
+            #files that failed have been reported and are left out
+            genotypesamplelist = [eachresult for eachresult in genotypesamplelist if eachresult is not None]
+            if not genotypesamplelist:
+                continue
+            for eachresult in genotypesamplelist:
+                printresult(eachresult['filename'], genotypename, eachresult)
+
+            genotyperesults.append({
+                'name': genotypename,
+                'samples': genotypesamplelist
+            })
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if cache.hits + cache.misses:
+        print(f"\nClassification cache: {cache.summary()}")
+
     if not genotyperesults:
         return
     
@@ -796,9 +2563,104 @@ def main():
 
 
     htmloutput = "htmloutput.html"
-    reportpath = generatehtmlreport(genotyperesults, htmloutput)
+    reportpath = generatehtmlreport(genotyperesults, htmloutput, topn)
     print(f"\nPath =  {reportpath}")
     webbrowser.open('file://' + os.path.realpath(reportpath))
 
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify CRISPResso allele frequency tables. With no --samplesheet the group/file dialogs open as before.")
+    parser.add_argument('--samplesheet', help="CSV/TSV with group, sample, path columns; runs without any windows")
+    parser.add_argument('--discover', metavar='ROOT', help="find every CRISPResso_on_* folder under ROOT instead of using a sample sheet")
+    parser.add_argument('--group', action='append', default=[], metavar='NAME=REGEX', help="with --discover/--watch: samples whose name matches REGEX go to group NAME (first match wins, repeatable)")
+    parser.add_argument('--platemap', help="with --discover/--watch: CSV/TSV of group plus sample or well (A1/A01) columns")
+    parser.add_argument('--watch', metavar='ROOT', help="like --discover, but keep polling ROOT and classify each sample as soon as CRISPResso2 finishes it")
+    parser.add_argument('--interval', type=float, default=30, metavar='SECONDS', help="with --watch: seconds between polls (default: 30)")
+    parser.add_argument('--expect', type=int, metavar='N', help="with --watch: stop once N samples are classified (default: run until Ctrl-C)")
+    parser.add_argument('--scan-workers', type=int, default=16, help="concurrent folder listings while discovering (default: 16)")
+    parser.add_argument('--output', default="htmloutput.html", help="HTML report path (default: htmloutput.html)")
+    parser.add_argument('--report', choices=['inline', 'payload', 'fragments'], default='inline',
+                        help="report layout: every table as HTML (inline, default), one JSON payload rendered in the browser (payload, much smaller for big plates) "
+                             "or an index page that loads each sample's tables from <output>_files/ when opened (fragments)")
+    parser.add_argument('--summary', help="prefix for the .csv/.json summaries (default: the report path without .html)")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument('--batch', action='store_true', help="use the NumPy batch classifier")
+    parser.add_argument('--top', type=int, default=100, help="sequences listed per sample in the report (default: 100)")
+    parser.add_argument('--memory-budget', type=int, metavar='MB', help="classify each table in row chunks that fit in about this much memory (for very large tables)")
+    parser.add_argument('--quiet', action='store_true', help="don't print per-sample numbers")
+    parser.add_argument('--ingest', action='store_true', help="first write a Parquet copy next to each allele table (needs pyarrow); later runs read those instead of the text")
+    parser.add_argument('--db', metavar='PATH', help="SQLite file collecting every run's results (appended to; queried by --query-group/--query-allele)")
+    parser.add_argument('--label', help="with --db: a note stored with this run")
+    parser.add_argument('--query-group', metavar='GROUP', help="with --db: print --field for every sample of GROUP across all stored runs, then exit")
+    parser.add_argument('--query-allele', metavar='SEQUENCE', help="with --db: print every stored sample that kept this aligned sequence, then exit")
+    parser.add_argument('--field', default='crpercentage', choices=STOREFIELDS, help="summary field for --query-group (default: crpercentage)")
+    parser.add_argument('--amplicons', metavar='FILE', help="JSON list of amplicons (name, reference, optional ruleset, marker, markeroffset); each sample is classified against the one its reads match")
+    parser.add_argument('--catalog', action='append', default=[], metavar='FILE', help="CSV/TSV of known alleles (sequence, label, optional match = exact/stripped) typed 'recomb' along with the built-in ones (repeatable)")
+    parser.add_argument('--rulesets', metavar='NAMES', help=f"also write <summary>.rulesets.csv comparing these rule sets side by side (comma separated, from: {', '.join(RULESETS)})")
+    parser.add_argument('--cachedir', default=os.path.join(os.path.expanduser('~'), '.cache', 'findfreq'), help="where classified results are cached (default: ~/.cache/findfreq)")
+    parser.add_argument('--cache-size', type=int, default=500, help="cache size limit in MB (default: 500)")
+    parser.add_argument('--refresh', action='store_true', help="reclassify every file even if a cached result exists")
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the result cache")
+    args = parser.parse_args(argv)
+    if args.top < 1:
+        parser.error("--top must be at least 1")
+    catalog = AlleleCatalog(KNOWNALLELES.entries)
+    for path in args.catalog:
+        try:
+            catalog.load(path)
+        except (OSError, ValueError, IndexError, csv.Error) as e:
+            parser.error(f"--catalog {path}: {e}")
+    args.catalog = catalog
+    if args.amplicons:
+        try:
+            args.amplicons = readamplicons(args.amplicons)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"--amplicons: {e}")
+
+    if args.query_group or args.query_allele:
+        if not args.db:
+            parser.error("--query-group/--query-allele need --db")
+        return runqueries(args)
+    if args.rulesets:
+        args.rulesets = [name.strip() for name in args.rulesets.split(',') if name.strip()]
+        unknown = [name for name in args.rulesets if name not in RULESETS]
+        if unknown:
+            parser.error(f"unknown rule set(s): {', '.join(unknown)}")
+        #every compared rule set needs its cut-site marker in each reference it is counted against
+        for reference, where in ([(amplicon.refsequence, f"amplicon {amplicon.name!r}") for amplicon in args.amplicons] if args.amplicons else [(REFSEQUENCE, "the reference")]):
+            for name in args.rulesets:
+                if RULESETS[name]['marker'] not in reference:
+                    parser.error(f"--rulesets: cut-site marker {RULESETS[name]['marker']} of {name} not in {where}")
+
+    if args.samplesheet:
+        try:
+            samplerows = readsamplesheet(args.samplesheet)
+        except (OSError, ValueError, IndexError, csv.Error) as e:
+            parser.error(f"--samplesheet {args.samplesheet}: {e}")
+        return runsamples(args, samplerows, args.samplesheet)
+    if args.discover or args.watch:
+        grouprules = []
+        for rule in args.group:
+            name, sep, pattern = rule.partition('=')
+            if not sep:
+                parser.error(f"--group expects NAME=REGEX, got {rule!r}")
+            grouprules.append((name, pattern))
+        try:
+            platemaprules = readplatemap(args.platemap) if args.platemap else []
+        except (OSError, ValueError, IndexError, csv.Error) as e:
+            parser.error(f"--platemap {args.platemap}: {e}")
+        if args.watch:
+            return watchsamples(args, grouprules, platemaprules)
+        samplerows = discoversamples(args.discover, grouprules, platemaprules, args.scan_workers)
+        print(f"Found {len(samplerows)} CRISPResso samples under {args.discover}")
+        return runsamples(args, samplerows, args.discover)
+    #the dialogs only write the HTML report, so options that feed the headless outputs have nowhere to go
+    headlessonly = [flag for flag, value in (('--rulesets', args.rulesets), ('--amplicons', args.amplicons), ('--db', args.db), ('--ingest', args.ingest)) if value]
+    if headlessonly:
+        parser.error(f"{', '.join(headlessonly)} need --samplesheet, --discover or --watch")
+    rundialogs(None if args.no_cache else ResultCache(args.cachedir, args.cache_size * 1024 * 1024, args.refresh), args.top, args.catalog,
+               args.workers, args.batch, argchunkrows(args))
+    return 0
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
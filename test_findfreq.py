@@ -0,0 +1,339 @@
+#the scalar classifier (classifyrow) is the reference; the NumPy batch path, the chunked path and the
+#per-amplicon rule sets have to give the same counts, top sequences and NHEJ alleles on the same table
+import os
+import sys
+import json
+import random
+import importlib.util
+import multiprocessing
+
+import pytest
+
+spec = importlib.util.spec_from_file_location('findfreq', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'findfreq2026-A4.py'))
+findfreq = importlib.util.module_from_spec(spec)
+#registered so pool workers can unpickle its functions and Allele records. only forked workers inherit
+#this; spawned ones would have to import a module called findfreq, so the pool tests use forkpool()
+sys.modules['findfreq'] = findfreq
+spec.loader.exec_module(findfreq)
+
+REF = findfreq.REFSEQUENCE
+HEADER = "Aligned_Sequence\tReference_Sequence\tUnedited\tn_deleted\tn_inserted\tn_mutated\t#Reads\t%Reads"
+COUNTS = ['totalreads', 'totalCORreads', 'csreads', 'crreads', 'nhejreads', 'otherreads', 'insertionreads', 'recombreads',
+          'cspercentage', 'crpercentage', 'nhejpercentage', 'HTRpercentage', 'knownreads']
+
+
+def delete(seq, start, length):
+    start = max(0, start)
+    return seq[:start] + '-' * len(seq[start:start + length]) + seq[start + length:]
+
+
+def casesrows():
+    #one row of every case the rules tell apart, on a CRISPResso-like 110 bp window of the a4 amplicon
+    #(one base off the window of the known recombinants, so only the recomb row is in the catalog)
+    offset = REF.find("TTCCGGTGCC") + 1
+    window = REF[offset:offset + 110]
+    cr = REF.find("TCGCCGCAG") + 9 - offset
+    cs = delete(window, 24, 12)
+    inserted = window[:50] + 'T' + window[50:]
+    return [
+        (window, window),                                    #wild type
+        (cs, window),                                        #CS only
+        (delete(window, cr, 3), window),                     #CR only
+        (delete(cs, cr, 3), window),                         #CS + CR
+        (delete(cs, cr - 1, 4), window),                     #CS + CR gap running into the base before
+        (delete(cs, cr, 4), window),                         #CS + CR gap running into the base after
+        (delete(cs, 70, 9), window),                         #CS + NHEJ
+        (delete(delete(cs, cr, 3), 80, 2), window),          #CS + CR + NHEJ elsewhere
+        (delete(window, cr, 3)[:cr + 1], window[:cr + 1]),   #CR window cut off at the end of the row
+        (findfreq.RECOMBSEQ1, findfreq.RECOMBSEQ2),          #known recombinant
+        (inserted, window[:50] + '-' + window[50:]),         #insertion: reference chunk not in the amplicon
+        (cs[:20], window[:20]),                              #row shorter than csfrom/gapsfrom
+    ]
+
+
+def randomrows(nrows, seed):
+    rnd = random.Random(seed)
+    start = REF.find("TTCCGGTGCC")
+    markers = [REF.find(rules['marker']) + len(rules['marker']) + rules['markeroffset'] for rules in findfreq.RULESETS.values()]
+    rows = []
+    for _ in range(nrows):
+        offset = start + rnd.choice([0, 0, 0, 1, -1, 3, 30])
+        window = REF[offset:offset + rnd.choice([110, 110, 60, 30])]
+        aligned, reference = window, window
+        for _ in range(rnd.choice([0, 1, 1, 2, 3])):
+            kind = rnd.random()
+            if kind < 0.3:
+                aligned = delete(aligned, rnd.choice([0, 1, 24]), rnd.choice([4, 5, 12, 13, 20]))
+            elif kind < 0.6:
+                aligned = delete(aligned, rnd.choice(markers) - offset + rnd.randint(-2, 1), rnd.choice([3, 3, 4, 5]))
+            elif kind < 0.85:
+                aligned = delete(aligned, rnd.randint(0, 100), rnd.randint(1, 25))
+            else:
+                p = rnd.randint(1, len(window) - 1)
+                aligned = aligned[:p] + rnd.choice('ACGT') + aligned[p:]
+                reference = reference[:p] + '-' + reference[p:]
+        rows.append((aligned, reference))
+    return rows
+
+
+def writetable(path, rows, seed=0):
+    rnd = random.Random(seed)
+    reads = sorted((max(1, int(rnd.paretovariate(1.2))) for _ in rows), reverse=True)
+    total = sum(reads)
+    with open(path, 'w') as f:
+        f.write(HEADER + '\n')
+        for (aligned, reference), count in zip(rows, reads):
+            f.write(f"{aligned}\t{reference}\tFalse\t{aligned.count('-')}\t{reference.count('-')}\t0\t{count}\t{count * 100 / total:.6f}\n")
+        #short rows are skipped, not classified
+        f.write("ACGT\tACGT\tFalse\n")
+    return str(path)
+
+
+def outcome(result):
+    NHEJList = sorted(result['NHEJList'], key=lambda allele: allele.__reduce__()[1])
+    return {field: result[field] for field in COUNTS}, result['topsequences'], NHEJList
+
+
+def forkpool(workers, *args, **kwargs):
+    #workerpool() on the fork start method, or skip where there is none (Windows)
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip("pool tests need the fork start method")
+    return findfreq.workerpool(workers, *args, mp_context=multiprocessing.get_context('fork'), **kwargs)
+
+
+@pytest.fixture(params=[0, 1, 2])
+def table(request, tmp_path):
+    rows = casesrows() + randomrows(400, request.param)
+    return writetable(tmp_path / 'Alleles_frequency_table.txt', rows, request.param)
+
+
+def test_cases_classify_as_expected():
+    refindex = findfreq.RefIndex(REF)
+    start, end = findfreq.crwindow(REF, findfreq.RULESETS['a4'])
+    types = [findfreq.classifyrow(aligned, reference, refindex, start, end)[0] for aligned, reference in casesrows()]
+    assert types == ['other', 'cs', 'cr', 'other', 'nhej', 'nhej', 'nhej', 'other', 'other', 'recomb', 'insertion', 'other']
+
+
+def test_gap_signature_drives_getldrun():
+    seq = 'AC-GT---A--C' + '-' * 3
+    assert findfreq.gapsignature(seq) == [(2, 1), (5, 3), (9, 2), (12, 3)]
+    assert findfreq.gapsignature(seq, 6) == [(6, 2), (9, 2), (12, 3)]
+    #the first of two equally long runs wins
+    assert findfreq.getLDrun(seq, 0) == (3, 5, 8, 4)
+    assert findfreq.getLDrun('ACGT', 0) == (0, -1, -1, 0)
+
+
+def test_batch_matches_scalar(table):
+    scalar = findfreq.classifyalleles(table, REF, topn=1000)
+    batch = findfreq.classifyalleles(table, REF, batch=True, topn=1000)
+    assert outcome(batch) == outcome(scalar)
+    assert scalar['recombreads'] and scalar['insertionreads'] and scalar['NHEJList']
+
+
+def test_batch_matches_scalar_top_n(table):
+    assert outcome(findfreq.classifyalleles(table, REF, batch=True, topn=5)) == outcome(findfreq.classifyalleles(table, REF, topn=5))
+
+
+def test_chunked_matches_scalar(table):
+    scalar = findfreq.classifyalleles(table, REF, topn=1000)
+    chunked = findfreq.classifyalleles(table, REF, topn=1000, chunkrows=37)
+    assert outcome(chunked) == outcome(scalar)
+    assert chunked['nhejalleles'] == len(scalar['NHEJList'])
+    assert chunked['nhejstats'] == findfreq.deletionstats(scalar['NHEJList'])
+
+
+def test_cached_scalar_matches_uncached(table):
+    cache = findfreq.ClassifyCache()
+    first = findfreq.classifyalleles(table, REF, cache=cache, topn=1000)
+    second = findfreq.classifyalleles(table, REF, cache=cache, topn=1000)
+    assert outcome(first) == outcome(second) == outcome(findfreq.classifyalleles(table, REF, topn=1000))
+    assert cache.hits >= cache.misses
+
+
+@pytest.mark.parametrize('ruleset', sorted(findfreq.RULESETS))
+def test_amplicon_rulesets_match_scalar(table, ruleset):
+    amplicon = findfreq.Amplicon(ruleset, REF, ruleset)
+    scalar = findfreq.classifyalleles(table, REF, topn=1000, amplicon=amplicon)
+    assert outcome(findfreq.classifyalleles(table, REF, batch=True, topn=1000, amplicon=amplicon)) == outcome(scalar)
+    assert outcome(findfreq.classifyalleles(table, REF, topn=1000, chunkrows=50, amplicon=amplicon)) == outcome(scalar)
+    compared = {field: scalar[field] for field in findfreq.RULESETNUMBERS if field in scalar}
+    for kwargs in ({}, {'batch': True}, {'chunkrows': 50}):
+        assert findfreq.classifyalleles(table, REF, rulesets=(ruleset,), **kwargs)['rulesets'][ruleset] == compared
+    if findfreq.RULESETS[ruleset]['artifwt']:
+        assert scalar['artifwtreads'] == findfreq.classifyalleles(table, REF, batch=True, amplicon=amplicon)['artifwtreads']
+
+
+def test_compared_rule_set_needs_its_marker(tmp_path, capsys):
+    #a4's marker TCGCCGCAG survives, the GATCGCC marker of the other rule sets does not
+    table = writetable(tmp_path / 'Alleles_frequency_table.txt', casesrows())
+    reference = REF.replace('GATCGCCGCAG', 'GCTCGCCGCAG')
+    amplicon = findfreq.Amplicon('moved', reference, 'a4')
+    with pytest.raises(ValueError, match='GATCGCC'):
+        findfreq.classifyalleles(table, reference, amplicon=amplicon, rulesets=('adj',))
+    amplicons = tmp_path / 'amplicons.json'
+    amplicons.write_text(json.dumps([{'name': 'moved', 'reference': reference}]))
+    with pytest.raises(SystemExit):
+        findfreq.main(['--samplesheet', table, '--amplicons', str(amplicons), '--rulesets', 'adj'])
+    assert 'GATCGCC of adj not in amplicon' in capsys.readouterr().err
+
+
+def test_pool_workers_report_memo_counts(tmp_path):
+    paths = [writetable(tmp_path / f's{i}.txt', casesrows() + randomrows(200, i), i) for i in range(3)]
+    cache = findfreq.ClassifyCache()
+    pool = forkpool(2, REF, topn=1000)
+    try:
+        pooled = findfreq.classifyfiles(paths, REF, cache=cache, topn=1000, pool=pool)
+        findfreq.classifyfiles(paths[:1], REF, cache=cache, topn=1000, pool=pool)
+    finally:
+        pool.shutdown()
+    inprocess = findfreq.classifyfiles(paths, REF, workers=1, topn=1000)
+    assert [outcome(result) for result in pooled] == [outcome(result) for result in inprocess]
+    #every row of the four classified tables went through a worker's memo
+    assert cache.hits + cache.misses == 4 * (len(casesrows()) + 200)
+    assert cache.hits and cache.workerentries
+
+
+def test_top_zero_keeps_nothing(table):
+    assert findfreq.classifyalleles(table, REF, topn=0)['topsequences'] == []
+    assert findfreq.classifyalleles(table, REF, batch=True, topn=0)['topsequences'] == []
+
+
+def test_header_less_table_keeps_its_first_row(tmp_path):
+    path = writetable(tmp_path / 'with.txt', casesrows())
+    with open(path) as f:
+        lines = f.readlines()
+    headerless = tmp_path / 'without.txt'
+    headerless.write_text(''.join(lines[1:]))
+    assert list(findfreq.readalleletable(str(headerless))) == list(findfreq.readalleletable(path))
+
+
+def test_header_missing_a_column_is_an_error(tmp_path):
+    path = tmp_path / 'renamed.txt'
+    path.write_text(HEADER.replace('#Reads', 'Reads') + '\n' + 'ACGT\tACGT\tFalse\t0\t0\t0\t5\t100.0\n')
+    with pytest.raises(ValueError, match='#Reads'):
+        list(findfreq.readalleletable(str(path)))
+
+
+@pytest.mark.parametrize('option', ['--catalog', '--samplesheet', '--platemap'])
+def test_missing_or_empty_sheets_are_usage_errors(tmp_path, capsys, option):
+    empty = tmp_path / 'empty.csv'
+    empty.write_text('')
+    for path in (str(empty), str(tmp_path / 'missing.csv')):
+        argv = [option, path] + (['--discover', str(tmp_path)] if option == '--platemap' else [])
+        with pytest.raises(SystemExit):
+            findfreq.main(argv)
+        assert f'{option} {path}:' in capsys.readouterr().err
+
+
+def test_allele_stores_type_code():
+    import pickle
+    allele = findfreq.Allele('AC--GT', 10, 50.0, 'nhej', 2, 2, 4, 1)
+    assert allele.typecode == findfreq.ALLELETYPES.index('nhej') and allele.type == 'nhej'
+    copy = pickle.loads(pickle.dumps(allele))
+    assert copy == allele and hash(copy) == hash(allele) and len({allele, copy}) == 1
+
+
+def test_memo_keeps_amplicons_with_the_same_window_apart(table):
+    #same name, rule set and CR window; the second reference differs past the cut site
+    cut = REF.find("TCGCCGCAG") + 20
+    first = findfreq.Amplicon('locus', REF)
+    second = findfreq.Amplicon('locus', REF[:cut] + ('A' if REF[cut] != 'A' else 'C') + REF[cut + 1:])
+    assert first.crdeletionstart == second.crdeletionstart
+    cache = findfreq.ClassifyCache()
+    findfreq.classifyalleles(table, REF, cache=cache, topn=1000, amplicon=first)
+    assert outcome(findfreq.classifyalleles(table, REF, cache=cache, topn=1000, amplicon=second)) == \
+        outcome(findfreq.classifyalleles(table, REF, topn=1000, amplicon=second))
+
+
+def test_duplicate_amplicon_names_are_rejected(tmp_path):
+    path = tmp_path / 'amplicons.json'
+    path.write_text('[{"name": "locus", "reference": "%s"}, {"name": "locus", "reference": "%s", "ruleset": "adj"}]' % (REF, REF))
+    with pytest.raises(ValueError, match='locus'):
+        findfreq.readamplicons(str(path))
+
+
+def test_columnar_copies_of_tables_with_the_same_stem(tmp_path):
+    pytest.importorskip('pyarrow')
+    import zipfile
+    text = writetable(tmp_path / 't.txt', casesrows() + randomrows(100, 0), 0)
+    other = writetable(tmp_path / 'other.txt', casesrows() + randomrows(100, 1), 1)
+    with zipfile.ZipFile(tmp_path / 't.zip', 'w') as zf:
+        zf.write(other, 'Alleles_frequency_table.txt')
+    expected = [findfreq.classifyalleles(path, REF, topn=1000) for path in (text, other)]
+    paths = [text, str(tmp_path / 't.zip')]
+    assert len({findfreq.ingestalleletable(path) for path in paths}) == 2
+    for path, want in zip(paths, expected):
+        assert findfreq.columnarrows(path) is not None
+        assert outcome(findfreq.classifyalleles(path, REF, topn=1000)) == outcome(want)
+
+
+def test_columnar_copy_of_a_changed_table_is_not_used(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = writetable(tmp_path / 't.txt', casesrows(), 0)
+    findfreq.ingestalleletable(path)
+    st = os.stat(path)
+    #same size and mtime, different content
+    with open(path, 'r+') as f:
+        lines = f.read().split('\n')
+        lines[1], lines[2] = lines[2], lines[1]
+        f.seek(0)
+        f.write('\n'.join(lines))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert findfreq.columnarrows(path) is None
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    findfreq.ingestalleletable(path)
+    assert list(findfreq.readalleletable(path)) == list(findfreq.readalleletable(path, columnar=False))
+
+
+def test_failed_ingestion_leaves_no_partial_copy(tmp_path, capsys):
+    pytest.importorskip('pyarrow')
+    path = writetable(tmp_path / 't.txt', casesrows())
+    with open(path, 'a') as f:
+        f.write('ACGT\tACGT\tFalse\t0\t0\t0\tmany\t1.0\n')
+    with pytest.raises(ValueError):
+        findfreq.ingestalleletable(path)
+    assert sorted(os.listdir(tmp_path)) == ['t.txt']
+    assert findfreq.ingestsample(path) == path and 'not ingested' in capsys.readouterr().out
+    assert findfreq.columnarrows(path) is None
+
+
+def test_store_keeps_rows_sharing_an_aligned_sequence(tmp_path):
+    #rows of one table with the same aligned sequence against different reference chunks, two of them tied;
+    #the top rows are also kept NHEJ alleles, the last NHEJ allele missed the top-N
+    top = [findfreq.Allele('AC--GT', 30, 30.0, 'nhej', 2, 2, 4, 1), findfreq.Allele('AC--GT', 30, 30.0, 'nhej', 2, 2, 4, 1),
+           findfreq.Allele('AC--GT', 20, 20.0, 'nhej', 2, 2, 4, 1)]
+    nhej = top + [findfreq.Allele('AC--GT', 20, 20.0, 'nhej', 2, 2, 4, 1)]
+    result = dict(findfreq.summariseresult('s.txt', dict.fromkeys(findfreq.ALLELETYPES, 0) | {'nhej': 100}, [], nhej, findfreq.RULESETS['a4']),
+                  topsequences=top, filename='s')
+    store = findfreq.ResultsStore(str(tmp_path / 'r.db'))
+    run = store.addrun([{'name': 'g', 'samples': [result]}], 'test')
+    assert [row[4] for row in store.samplescontaining('AC--GT')] == [30, 30, 20, 20]
+    assert store.db.execute("SELECT typeof(nhejreads), typeof(nhejpercentage) FROM samples").fetchone() == ('integer', 'real')
+    assert [row[4] for row in store.groupvalues('g', 'nhejreads')] == [100] and run == 1
+    store.close()
+
+
+def test_header_only_table_classifies_to_zero(tmp_path):
+    path = tmp_path / 'empty.txt'
+    path.write_text(HEADER + '\n')
+    for kwargs in ({}, {'batch': True}, {'chunkrows': 10}):
+        result = findfreq.classifyalleles(str(path), REF, **kwargs)
+        assert result['totalreads'] == 0 and result['HTRpercentage'] == 0
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_bad_sample_is_skipped(tmp_path, capsys, workers):
+    good = writetable(tmp_path / 'good.txt', casesrows(), 0)
+    bad = tmp_path / 'bad.txt'
+    bad.write_text(HEADER.replace('#Reads', 'Reads') + '\n')
+    resultcache = findfreq.ResultCache(str(tmp_path / 'cache'))
+    pool = forkpool(workers, REF, cachedir=resultcache.cachedir)
+    try:
+        results = findfreq.classifyfiles([str(bad), good, str(tmp_path / 'missing.txt')], REF, workers=workers, resultcache=resultcache, pool=pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    assert results[0] is None and results[2] is None
+    assert outcome(results[1]) == outcome(findfreq.compactresult(findfreq.classifyalleles(good, REF)))
+    out = capsys.readouterr().out
+    assert 'bad.txt: ValueError' in out and 'missing.txt' in out